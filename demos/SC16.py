@@ -191,10 +191,11 @@ def main():
     for f in args.files:
         if args.output:
             print("Downloading")
-            diff, res = sess.download(f, args.output, schedule=down_sched)
+            result = sess.download(f, args.output, schedule=down_sched)
         else:
             print("Copying")
-            diff, res = sess.copy(f, upload_schedule=up_sched, download_schedule=down_sched)
+            result = sess.copy(f, upload_schedule=up_sched, download_schedule=down_sched)
+        diff, res = result.time, result.exnode
 
         print ("{0} ({1} {2:.2f} MB/s) {3}".format(res.name, res.size,
                                                    res.size/1e6/diff,
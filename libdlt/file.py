@@ -1,61 +1,289 @@
-import copy, socket, time
+import bisect, copy, io, itertools, math, socket, threading, time, weakref
 
-from libdlt.util.files import ExnodeInfo
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from libdlt.util.files import ExtentIndex
 from libdlt.depot import Depot
 from libdlt.protocol import factory, exceptions
-from libdlt.settings import BLOCKSIZE
+from libdlt.settings import BLOCKSIZE, CACHE_SIZE, READAHEAD, THREADS
 from lace import logging
 
 class FileError(OSError):
     pass
 
 log = logging.getLogger("libdlt.file")
-class DLTFile(object):
-    def __init__(self, ex, mode="r", *, dest=None, bs=BLOCKSIZE):
+class BlockCache(object):
+    """
+    Least recently used cache of loaded extents bounded by `budget`
+    bytes.  Blocks are keyed by their offset in the file, so any replica
+    of a range satisfies a lookup.  The cache is shared between threads
+    and between files open on the same exnode.
+    """
+    def __init__(self, budget=CACHE_SIZE):
+        self.budget, self.size = budget, 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._blocks, self._offsets, self._span = OrderedDict(), [], 0
+
+    def _covering(self, offset):
+        # Caller must hold self._lock
+        i = bisect.bisect_right(self._offsets, offset)
+        while i > 0 and self._offsets[i - 1] > offset - self._span:
+            i -= 1
+            a, _ = self._blocks[self._offsets[i]]
+            if a.offset + a.size > offset: return self._offsets[i]
+
+    def __contains__(self, offset):
+        with self._lock:
+            return self._covering(offset) is not None
+
+    def get(self, offset):
+        """
+        Return the cached (alloc, data) covering offset or None.
+        """
+        with self._lock:
+            k = self._covering(offset)
+            if k is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._blocks.move_to_end(k)
+            return self._blocks[k]
+
+    def put(self, alloc, data):
+        with self._lock:
+            if alloc.offset in self._blocks:
+                self.size -= len(self._blocks[alloc.offset][1])
+            else:
+                bisect.insort(self._offsets, alloc.offset)
+            self._blocks[alloc.offset] = (alloc, data)
+            self._blocks.move_to_end(alloc.offset)
+            self._span, self.size = max(self._span, alloc.size), self.size + len(data)
+            while self.size > self.budget and len(self._blocks) > 1:
+                k, (_, old) = self._blocks.popitem(last=False)
+                self._offsets.remove(k)
+                self.size, self.evictions = self.size - len(old), self.evictions + 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._offsets, self.size = [], 0
+
+    def stats(self):
+        with self._lock:
+            return { "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                     "blocks": len(self._blocks), "size": self.size, "budget": self.budget }
+
+# Files open on the same exnode share one cache, the budget is set by
+# whichever file opens it first
+_caches, _caches_lock = weakref.WeakValueDictionary(), threading.Lock()
+def _cache_for(ex, budget):
+    key = getattr(ex, "id", None) or id(ex)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = BlockCache(budget)
+        return cache
+
+class DLTFile(io.RawIOBase):
+    """
+    Raw binary file access to an exnode, suitable for wrapping in
+    `io.BufferedReader` or handing to libraries expecting a file object.
+    `readinto` and `read` fill the caller's buffer across extent
+    boundaries straight from the loaded blocks, fetching every extent a
+    request spans in parallel.  Extents are looked up through an
+    `ExtentIndex`, and replicas on depots that have failed this file
+    are tried last.  Sequential reads prefetch up to
+    `readahead` extents past the head in background workers; the window
+    in use grows or shrinks with the ratio of block fetch time to the
+    time the reader spends consuming each block.  `readahead=0` disables
+    prefetching.  Loaded blocks are kept in a `BlockCache` of up to
+    `cache_size` bytes shared with other files open on the same exnode.
+
+    With `writebehind` set, full blocks are staged in the background with
+    up to that many stores in flight while the writer keeps filling the
+    next block.  A failed store is raised by the next `write` or `close`.
+    """
+    def __init__(self, ex, mode="r", *, dest=None, bs=BLOCKSIZE, readahead=READAHEAD, cache_size=CACHE_SIZE,
+                 writebehind=0):
         self._bs, self._ex = bs, ex
         self._chunk = None if "r" in mode else bytearray(bs)
-        self._offset = self._head = 0 if "a" not in mode else ex.size
+        self._offset, self._head = 0, 0 if "a" not in mode else ex.size
         self.t, self._mode = None, mode
+        self._readahead, self._window, self._next = readahead, 1, self._head
+        self._pending, self._workers = {}, None
+        self._rate, self._last = {"fetch": None, "consume": None}, None
+        self.cache = _cache_for(ex, cache_size)
+        self._index, self._indexed, self._failures = ExtentIndex(), 0, Counter()
+        self._writebehind, self._inflight, self._error = writebehind, deque(), None
+        self._stagers = ThreadPoolExecutor(max_workers=writebehind) if writebehind else None
         if dest:
             self._dest, self._proxy = Depot(dest), factory.makeProxyFromURI(dest)
 
-    def fileno(self): return 3
+    def readable(self): return "r" in self._mode
+    def writable(self): return "w" in self._mode or "a" in self._mode
+    def seekable(self): return True
+    def tell(self): return self._head
 
-    def seek(self, offset, whence=0):
-        if whence == 0: self._head = offset
-        elif whence == 1: self._head += offset
-        else: self._head = self._ex.size - offset
-        self._chunk = None
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET: pos = offset
+        elif whence == io.SEEK_CUR: pos = self._head + offset
+        elif whence == io.SEEK_END: pos = self._ex.size + offset
+        else: raise ValueError(f"Invalid whence ({whence}, should be 0, 1 or 2)")
+        if pos < 0: raise ValueError(f"Negative seek position {pos}")
+        self._head = pos
+        self._retire(lambda a: a.offset + a.size <= pos)
+        return pos
 
     def settimeout(self, timeout):
         self.t = timeout
 
-    def read(self, size=-1):
-        def _get():
+    def _observe(self, k, v):
+        prev = self._rate[k]
+        self._rate[k] = v if prev is None else 0.7 * prev + 0.3 * v
+
+    def _load(self, a):
+        t = time.time()
+        data = factory.makeProxy(a).load(a, timeout=self.t)
+        self._observe("fetch", time.time() - t)
+        return data
+
+    def _replicas(self, offset):
+        # Extents are only ever appended, so new ones are indexed as they
+        # appear, such as while the exnode is still being uploaded
+        extents = self._ex.extents
+        if len(extents) < self._indexed:
+            self._index, self._indexed = ExtentIndex(), 0
+        for a in itertools.islice(extents, self._indexed, None):
+            self._index.add(a)
+        self._indexed = len(extents)
+        return sorted(self._index.covering(offset), key=lambda a: self._failures[a.location])
+
+    def _find(self, offset):
+        replicas = self._replicas(offset)
+        return replicas[0] if replicas else None
+
+    def _prefetch(self, offset):
+        fetch, consume = self._rate["fetch"], self._rate["consume"]
+        if fetch is not None and consume is not None:
+            # Keep enough blocks in flight to cover one fetch at the
+            # rate the reader is consuming them
+            self._window = max(1, min(self._readahead, math.ceil(fetch / max(consume, 1e-6))))
+        for _ in range(self._window):
+            a = self._find(offset) if offset < self._ex.size else None
+            if a is None: return
+            if a.offset not in self._pending and a.offset not in self.cache:
+                log.debug(f"   Prefetching block {a.offset}-{a.offset+a.size}")
+                self._pending[a.offset] = (a, self._submit(a))
+            offset = a.offset + a.size
+
+    def _submit(self, a):
+        if self._workers is None:
+            self._workers = ThreadPoolExecutor(max_workers=max(self._readahead, THREADS))
+        return self._workers.submit(self._load, a)
+
+    def _retire(self, stale):
+        for k in [k for k, (a, _) in self._pending.items() if stale(a)]:
+            self._pending.pop(k)[1].cancel()
+
+    def _span(self, start, end):
+        # Readahead past the span is only kept while reading sequentially
+        seq = start == self._next
+        self._retire(lambda a: a.offset + a.size <= start or not (seq or a.offset < end))
+        blocks, offset = [], start
+        while offset < end:
+            a = self._find(offset)
+            if a is None: break
+            blocks.append(a)
+            offset = a.offset + a.size
+        if len(blocks) > 1:
+            c = self._chunk
+            for a in blocks:
+                if a.offset in self._pending or a.offset in self.cache or (c is not None and c[0] is a): continue
+                self._pending[a.offset] = (a, self._submit(a))
+
+    def _take_pending(self):
+        a = self._find(self._head)
+        hit = self._pending.pop(a.offset, None) if a is not None else None
+        if hit is not None and hit[0].offset + hit[0].size <= self._head:
+            hit[1].cancel()
+        elif hit is not None:
+            try: return (hit[0], hit[1].result())
+            except Exception as e:
+                self._failures[hit[0].location] += 1
+                log.warn(f"Prefetch of {hit[0].offset}-{hit[0].offset+hit[0].size} failed - {e}")
+                self._resubmit(hit[0].location)
+
+    def _resubmit(self, location):
+        # Blocks still pending on a failed depot are sent to whichever
+        # replica _replicas now prefers
+        for k, (a, f) in list(self._pending.items()):
+            if a.location != location or (f.done() and not f.cancelled() and f.exception() is None): continue
+            b = self._find(a.offset)
+            if b is a: continue
+            self._pending.pop(k)[1].cancel()
+            if b.offset not in self._pending and b.offset not in self.cache:
+                self._pending[b.offset] = (b, self._submit(b))
+
+    def _get(self):
+        now, seq = time.time(), self._head == self._next
+        if seq and self._last is not None: self._observe("consume", now - self._last)
+        self._chunk = self.cache.get(self._head) or self._take_pending()
+        if self._chunk is None:
             log.debug(f"Data no cached, pulling block @{self._head}")
             for _ in range(3):
-                for a in self._ex.extents:
-                    if a.offset <= self._head and a.offset + a.size > self._head:
-                        try:
-                            self._chunk = (a, factory.makeProxy(a).load(a, timeout=self.t))
-                            log.debug(f"   Found matching block {a.offset}-{a.offset+a.size}")
-                            return
-                        except socket.timeout: pass
+                for a in self._replicas(self._head):
+                    try:
+                        self._chunk = (a, self._load(a))
+                        log.debug(f"   Found matching block {a.offset}-{a.offset+a.size}")
+                        break
+                    except (OSError, exceptions.AllocationError) as e:
+                        self._failures[a.location] += 1
+                        log.warn(f"   Failed to load {a.offset}-{a.offset+a.size} @ {a.location} - {e}")
+                if self._chunk is not None: break
                 time.sleep(0.1)
-            raise IOError("Incomplete file, no allocations satisfy request")
-
-        if self._head >= self._ex.size: return bytes()
-        if self._chunk is None or self._head < self._chunk[0].offset or self._head >= self._chunk[0].offset + self._chunk[0].size:
-            _get()
-        s = self._head - self._chunk[0].offset
-        if size == -1: size = self._chunk[0].size - s
-        else: size = min(self._chunk[0].size - s, size)
-        log.debug(f"<-- Read {self._head}-{self._head + size}")
-        self._head = self._chunk[0].offset + s + size
-        return bytes(self._chunk[1][s:s+size])
+            else:
+                raise IOError("Incomplete file, no allocations satisfy request")
+        self.cache.put(*self._chunk)
+        self._last, self._next = time.time(), self._chunk[0].offset + self._chunk[0].size
+        if seq and self._readahead: self._prefetch(self._next)
+
+    def _block(self):
+        c = self._chunk
+        if c is None or self._head < c[0].offset or self._head >= c[0].offset + c[0].size:
+            self._get()
+        return self._chunk
+
+    def readinto(self, b):
+        if self.closed: raise ValueError("I/O operation on closed file")
+        view, n = memoryview(b).cast('B'), 0
+        self._span(self._head, min(self._head + len(view), self._ex.size))
+        while n < len(view) and self._head < self._ex.size:
+            a, data = self._block()
+            s = self._head - a.offset
+            size = min(a.size - s, len(view) - n)
+            view[n:n+size] = memoryview(data)[s:s+size]
+            n, self._head = n + size, self._head + size
+        log.debug(f"<-- Read {self._head-n}-{self._head}")
+        return n
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes, or to the end of the file if size is
+        negative.  Fewer bytes are only returned at the end of the file.
+        """
+        if self.closed: raise ValueError("I/O operation on closed file")
+        end = self._ex.size if size is None or size < 0 else min(self._head + size, self._ex.size)
+        if end <= self._head: return bytes()
+        data = bytearray(end - self._head)
+        return bytes(memoryview(data)[:self.readinto(data)])
 
     def write(self, data):
+        if self.closed: raise ValueError("I/O operation on closed file")
         log.debug(f"Writing {len(data)} bytes to {self._dest.host}:{self._dest.port}")
+        self._reap(self._writebehind)
+        data = memoryview(data).cast('B')
 
         wrote = 0
         while len(data) > 0:
@@ -70,93 +298,65 @@ class DLTFile(object):
 
             # if block is full
             if self._offset >= self._bs:
-                self._offset = 0
-                # Store data in staging
-                alloc = self._proxy.allocate(self._dest, 0, len(self._chunk), timeout=self.t)
-                log.debug(f"Attempting to stage {self._head}-{self._head+len(self._chunk)}")
-                try: self._proxy.store(alloc, self._chunk, len(self._chunk), timeout=self.t)
-                except (socket.timeout, exceptions.AllocationError) as e:
-                    err = f"Unable to stage {self._head}-{self._head+len(self._chunk)}"
-                    raise OSError(err) from e
-                alloc.parent, alloc.offset = self._ex, self._head
-                try: del alloc.getObject().__dict__['function']
-                except KeyError: pass
-                self._ex.extents.append(alloc)
-                self._head += alloc.size
-                self._ex.size += alloc.size
+                self._offset, buf = 0, self._chunk
+                if self._writebehind: self._chunk = bytearray(self._bs)
+                self._flush_block(buf)
         return wrote
 
-    def close(self):
-        if "w" in self._mode and self._offset != 0:
-            o = self._offset
-            alloc = self._proxy.allocate(self._dest, 0, o, timeout=self.t)
-            log.debug(f"Attempting to stage {self._head}-{self._head+o}")
-            try:
-                self._proxy.store(alloc, self._chunk[:o], o, timeout=self.t)
-            except (socket.timeout, exceptions.AllocationError) as e:
-                err = f"Unable to stage {self._head}-{self._head+o}"
-                raise OSError(err) from e
-            alloc.parent, alloc.offset = self._ex, self._head
-            try: del alloc.getObject().__dict__['function']
-            except KeyError: pass
-            self._ex.extents.append(alloc)
-            self._head += alloc.size
-            self._ex.size += alloc.size
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close()
-    
-"""
-class DLTFile(object):
-    def __init__(self, ex):
-        self._ex, self._h = ex, 0
-        self.info = ExnodeInfo(ex, remote_validate=True)
-        self._view, self._viewframe = bytearray(), (0,0)
-
-    def _get_chunk(self, alloc):
-        print(f"Getting allocation: {alloc.offset}-{alloc.offset+alloc.size}")
-        proxy = factory.makeProxy(alloc)
-        if not hasattr(alloc, 'depot'): alloc.depot = Depot(alloc.location)
-        try: return proxy.load(alloc)
-        except exceptions.AllocationError as e:
-            log.warn("Failed to connect with allocation - " + alloc.location)
-            raise FileError("Allocation failed to load")
-
-    def fileno(self): return 3
-    
-    def seek(self, offset, whence=0):
-        if whence == 0: self._h = offset
-        elif whence == 1: self._h += offset
-        else: self._h = self._ex.size - offset
-        self._view, self._viewframe = bytearray(), (self._h, self._h)
+    def _stage(self, buf, offset):
+        alloc = self._proxy.allocate(self._dest, 0, len(buf), timeout=self.t)
+        log.debug(f"Attempting to stage {offset}-{offset+len(buf)}")
+        try: self._proxy.store(alloc, buf, len(buf), timeout=self.t)
+        except (socket.timeout, exceptions.AllocationError) as e:
+            err = f"Unable to stage {offset}-{offset+len(buf)}"
+            raise OSError(err) from e
+        return alloc
 
-    def read(self, size=-1):
-        def _stage(start):
-            alloc = self.info.alloc_in(start)
-            if not alloc: return False
-            self._view = self._get_chunk(alloc)
-            self._viewframe = (alloc.offset, alloc.offset + alloc.size)
-            return True
-        size = size if isinstance(size, int) and size > 0 else self._ex.size - self._h
-        print(f"Reading from: {size}")
-        end, tail = self._h + size, 0
-        data = bytearray(size)
-        if self._h >= self._viewframe[1]:
-            if not _stage(self._h):
-                return bytes()
-        _s = self._h - self._viewframe[0]
-        if end > self._viewframe[1]:
-            _e = self._viewframe[1] - _s
-            data[:_e] = self._view[_s:]
-            if not _stage(self._viewframe[1]):
-                self._h = self._viewframe[1]
-                return bytes(data[:_e])
-            data[_e:] = self._view[:size-_e]
+    def _attach(self, alloc, offset):
+        alloc.parent, alloc.offset = self._ex, offset
+        try: del alloc.getObject().__dict__['function']
+        except KeyError: pass
+        self._ex.extents.append(alloc)
+        self._ex.size += alloc.size
+
+    def _flush_block(self, buf):
+        if not self._writebehind:
+            self._attach(self._stage(buf, self._head), self._head)
         else:
-            data = self._view[_s:_s+size]
-        self._h += len(data)
-        return bytes(data)
-"""
+            self._reap(self._writebehind - 1)
+            self._inflight.append((self._head, self._stagers.submit(self._stage, buf, self._head)))
+        self._head += len(buf)
+
+    def _reap(self, keep=0):
+        """
+        Attach staged blocks in file order, waiting until at most `keep`
+        stores remain in flight.  Once a store fails the error is raised
+        here on every call.
+        """
+        while self._error is None and self._inflight and \
+              (len(self._inflight) > keep or self._inflight[0][1].done()):
+            offset, f = self._inflight.popleft()
+            try: self._attach(f.result(), offset)
+            except Exception as e:
+                self._error = e
+                for _, f in self._inflight: f.cancel()
+                self._inflight.clear()
+        if self._error is not None: raise self._error
+
+    def close(self):
+        if self.closed: return
+        for _, f in self._pending.values(): f.cancel()
+        self._pending = {}
+        if self._workers is not None:
+            self._workers.shutdown(wait=False)
+            self._workers = None
+        try:
+            if self.writable() and self._offset != 0:
+                buf, self._offset = self._chunk[:self._offset], 0
+                self._flush_block(buf)
+            self._reap()
+        finally:
+            if self._stagers is not None:
+                self._stagers.shutdown(wait=False)
+                self._stagers = None
+            super().close()
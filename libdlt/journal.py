@@ -0,0 +1,56 @@
+import hashlib, json, os
+
+from lace import logging
+from lace.logging import trace
+
+from libdlt.settings import DLT_ROOT
+
+class TransferJournal(object):
+    """
+    Append-only record of the completed pieces of a single transfer, kept
+    under DLT_ROOT/journal.  Entries are written as one JSON line each as
+    soon as a piece completes, so an interrupted transfer can be restarted
+    from what the journal holds.  The journal is identified by `kind` and
+    a key describing the transfer, such as the source path and its mtime.
+    """
+    @trace.debug("TransferJournal")
+    def __init__(self, kind, *key):
+        digest = hashlib.sha1(json.dumps([kind] + [str(k) for k in key]).encode()).hexdigest()
+        self.path = os.path.join(DLT_ROOT, "journal", "{}-{}.log".format(kind, digest))
+        self._fh = None
+        self.log = logging.getLogger('libdlt.journal')
+
+    @trace.info("TransferJournal")
+    def entries(self):
+        result = []
+        if not os.path.exists(self.path):
+            return result
+        with open(self.path) as fh:
+            for line in fh:
+                try:
+                    result.append(json.loads(line))
+                except ValueError:
+                    # An interrupted write leaves at most one torn entry
+                    self.log.warn("Skipping damaged journal entry in {}".format(self.path))
+        return result
+
+    @trace.debug("TransferJournal")
+    def record(self, **entry):
+        if self._fh is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fh = open(self.path, 'a')
+        self._fh.write(json.dumps(entry) + "\n")
+        self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    @trace.info("TransferJournal")
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
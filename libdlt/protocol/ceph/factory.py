@@ -37,6 +37,11 @@ async def makeAllocation(data, offset, depot, **kwds):
     alloc.size = len(data)
     await ceph.write(oid, data, loop, **kwds)
     return CephAdaptor(alloc)
+makeAllocationAsync = makeAllocation
+
+@trace.info("Ceph.factory")
+def shutdown():
+    ceph.close()
 
 class CephAdaptor(object):
     @trace.debug("CephAdaptor")
@@ -51,11 +56,20 @@ class CephAdaptor(object):
     def read(self, loop, **kwds):
         o = urisplit(self._allocation.location)
         parts = o.path.split('/')
-        size = self._allocation.size
-        return ceph.read(parts[1], parts[2], size, loop, **kwds)
+        offset = kwds.pop('offset', None) or 0
+        size = kwds.pop('size', None) or self._allocation.size - offset
+        return ceph.read(parts[1], parts[2], size, loop, offset=offset, **kwds)
+
+    @trace.info("CephAdaptor")
+    async def aread(self, **kwds):
+        return await self.read(asyncio.get_event_loop(), **kwds)
     
     @trace.info("CephAdaptor")
     def copy(self, depot, src_kwds, dst_kwds, **kwargs):
+        return asyncio.run(self.acopy(depot, src_kwds, dst_kwds, **kwargs))
+
+    @trace.info("CephAdaptor")
+    async def acopy(self, depot, src_kwds, dst_kwds, **kwargs):
         dst_alloc = CephExtent()
         dst_oid = str(uuid.uuid4())
         pool = dst_kwds.get('pool', 'dlt')
@@ -68,5 +82,5 @@ class CephAdaptor(object):
         src = src.path.split('/')
         size = self._allocation.size
         
-        ceph.copy(src[1], src[2], dst_oid, size, src_kwds, dst_kwds)
+        await ceph.copy(src[1], src[2], dst_oid, size, asyncio.get_event_loop(), src_kwds, dst_kwds)
         return CephAdaptor(dst_alloc)
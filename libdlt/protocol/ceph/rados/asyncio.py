@@ -15,55 +15,81 @@ class Cluster(rados.Cluster):
         ioctx = rados._open_ioctx_raw(pool_name)
         return Ioctx(pool_name, rados.librados, ioctx, loop=loop)
 
+# librados calls back into completions after the awaiting coroutine may
+# have been cancelled, so they are kept alive here until the callback runs
+_inflight = set()
+
 class _Completion(rados.Completion):
-    def __init__(self, ioctx: Ioctx, loop, wait_on_safe=False):
+    def __init__(self, ioctx: Ioctx, loop, wait_on_safe=False, keep=None):
         """
         :param safe: can't be True for read operation
+        :param keep: buffers librados reads or writes until completion
         """
         self.loop = loop
-        self.future = asyncio.Future(loop=loop)
+        self.future = loop.create_future()
+        self._keep = keep
         if wait_on_safe:
             super().__init__(ioctx, onsafe=self.__done)
         else:
             super().__init__(ioctx, oncomplete=self.__done)
 
     def __done(self, _):
-        self.loop.call_soon_threadsafe(self.future.set_result, True)
+        self.loop.call_soon_threadsafe(self.__resolve)
+
+    def __resolve(self):
+        _inflight.discard(self)
+        if not self.future.done():
+            self.future.set_result(True)
 
-    @asyncio.coroutine
-    def complete(self):
-        yield from self.future
+    async def complete(self):
+        # Called straight after the operation is submitted, the callback
+        # cannot be resolved before this coroutine first yields
+        _inflight.add(self)
+        await self.future
         # after this point we can GC the _Completion object, because we are sure
         # the only CB has completed
         return self.get_return_value()
 
 class Ioctx(rados.Ioctx):
+    """
+    Ioctx whose aio calls are awaitable.  Without an explicit loop each
+    call completes on the loop running it, so one ioctx can be shared
+    between event loops.
+    """
     def __init__(self, name, librados, io, loop=None):
-        self.loop = loop if loop else asyncio.get_event_loop()
+        self._loop = loop
         super().__init__(name, librados, io)
 
-    @asyncio.coroutine
-    def aio_read(self, oid: str, length=8192, offset=0):
+    @property
+    def loop(self):
+        return self._loop or asyncio.get_running_loop()
+
+    async def aio_read(self, oid: str, length=8192, offset=0):
         com = _Completion(self, self.loop)
         buffer = super().aio_read(oid, com, length=length, offset=offset)
-        ret = yield from com.complete()
+        com._keep = buffer
+        ret = await com.complete()
         if ret < 0:
             raise rados.make_ex(ret, "Ioctx.aio_read(%s): failed to read %s" % (self.name, oid))
 
         return buffer.read(ret)
 
-    @asyncio.coroutine
-    def aio_read_op_operate(self, oid: str, op: ReadOperation, flags=Operation.Flag.none):
-        com = _Completion(self, self.loop)
+    async def aio_read_op_operate(self, oid: str, op: ReadOperation, flags=Operation.Flag.none):
+        com = _Completion(self, self.loop, keep=op)
         super().aio_read_op_operate(oid, op, com, flags)
-        ret = yield from com.complete()
+        ret = await com.complete()
         if ret < 0:
             raise rados.make_ex(ret, "Ioctx.aio_read_op_operate(%s): failed to read %s" % (self.name, oid))
 
-    @asyncio.coroutine
-    def aio_write_op_operate(self, oid: str, op: WriteOperation, time=None, flags=Operation.Flag.none, wait_on_safe=False):
-        com = _Completion(self, self.loop, wait_on_safe)
+    async def aio_write_op_operate(self, oid: str, op: WriteOperation, time=None, flags=Operation.Flag.none,
+                                   wait_on_safe=False, keep=None):
+        com = _Completion(self, self.loop, wait_on_safe, keep=(op, keep))
         super().aio_write_op_operate(oid, op, com, time, flags)
-        ret = yield from com.complete()
+        ret = await com.complete()
         if ret < 0:
             raise rados.make_ex(ret, "Ioctx.aio_write_op_operate(%s): failed to read %s" % (self.name, oid))
+
+    async def aio_write_full(self, oid: str, data: bytes):
+        op = self.write_op_create()
+        op.write_full(data)
+        await self.aio_write_op_operate(oid, op, keep=data)
@@ -1,13 +1,69 @@
-import asyncio
+import asyncio, threading, time
 
-from libdlt.protocol.ceph.rados.core import Cluster
+from collections import OrderedDict
 
+from libdlt.protocol.ceph.rados.asyncio import Cluster
+from libdlt.protocol.ceph.settings import IOCTX_MAXSIZE, IOCTX_IDLE
+
+from lace import logging
 from lace.logging import trace
 
+class IoctxCache(object):
+    """
+    Bounded cache of open ioctxs keyed by (cluster, pool).  At most
+    `maxsize` are kept, least recently used first out, and ioctxs unused
+    for `idle` seconds are dropped.  Dropped ioctxs are closed once the
+    last operation holding them completes, so eviction never closes one
+    out from under an in-flight request.
+    """
+    def __init__(self, maxsize=IOCTX_MAXSIZE, idle=IOCTX_IDLE):
+        self._log = logging.getLogger('libdlt.ceph')
+        self._maxsize, self._idle_timeout = maxsize, idle
+        self._lock = threading.Lock()
+        self._ioctxs = OrderedDict()
+
+    def _evict(self, now):
+        # Caller must hold self._lock
+        while self._ioctxs:
+            key, (_, last_used) = next(iter(self._ioctxs.items()))
+            if len(self._ioctxs) <= self._maxsize and now - last_used <= self._idle_timeout: break
+            self._log.debug(f"Evicting ioctx for {key}")
+            del self._ioctxs[key]
+
+    def get(self, key):
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            if key not in self._ioctxs: return None
+            self._ioctxs[key][1] = now
+            self._ioctxs.move_to_end(key)
+            return self._ioctxs[key][0]
+
+    def put(self, key, ioctx):
+        """
+        Cache ioctx under key and return the cached ioctx, which is an
+        existing one if another caller opened the same pool first.
+        """
+        with self._lock:
+            if key in self._ioctxs:
+                return self._ioctxs[key][0]
+            self._ioctxs[key] = [ioctx, time.time()]
+            self._evict(time.time())
+            return ioctx
+
+    def __len__(self):
+        return len(self._ioctxs)
+
+    @trace.info("Ceph.IoctxCache")
+    def close(self):
+        with self._lock:
+            self._ioctxs.clear()
+
 class ProtocolService(object):
     @trace.debug("Ceph.ProtocolService")
     def __init__(self):
         self.cluster_cache = dict()
+        self.ioctx_cache = IoctxCache()
         
     @trace.debug("Ceph.ProtocolService")
     async def _get_cluster(self, loop, **kwds):
@@ -20,33 +76,38 @@ class ProtocolService(object):
             await loop.run_in_executor(None, cluster.connect)
             self.cluster_cache[conf] = cluster
         return cluster
-        
+
+    @trace.debug("Ceph.ProtocolService")
+    async def _get_ioctx(self, loop, pool, **kwds):
+        # Completion based ioctxs are kept open per pool, operations on
+        # them are issued without blocking or hopping to an executor
+        key = (kwds.get("config", ''), pool)
+        ioctx = self.ioctx_cache.get(key)
+        if ioctx is None:
+            cluster = await self._get_cluster(loop, **kwds)
+            ioctx = self.ioctx_cache.put(key, cluster.open_aioctx(pool))
+        return ioctx
+
     @trace.info("Ceph.ProtocolService")
-    def copy(self, p, src_oid, dst_oid, size, src_kwds, dst_kwds):
-        src_cluster = self._get_cluster(**src_kwds)
-        dst_cluster = self._get_cluster(**dst_kwds)
-        ioctx = src_cluster.open_ioctx(p)
-        data = ioctx.read(src_oid, size)
-        
-        ioctx.close()
+    def close(self):
+        self.ioctx_cache.close()
         
-        pool = dst_kwds.get("pool", "dlt")
-        ioctx = dst_cluster.open_ioctx(pool)
-        ioctx.write_full(dst_oid, data)
-        ioctx.close()
+    @trace.info("Ceph.ProtocolService")
+    async def copy(self, p, src_oid, dst_oid, size, loop, src_kwds, dst_kwds):
+        # RADOS has no cross-cluster copy, the object passes through here
+        data = await self.read(p, src_oid, size, loop, **src_kwds)
+        await self.write(dst_oid, data, loop, **dst_kwds)
     
     @trace.info("Ceph.ProtocolService")
     async def write(self, oid, data, loop, **kwds):
-        cluster = await self._get_cluster(loop, **kwds)
-        pool = kwds.get("pool", "dlt")
-        ioctx = cluster.open_ioctx(pool)
-        await loop.run_in_executor(None, ioctx.write_full, oid, data)
-        ioctx.close()
+        ioctx = await self._get_ioctx(loop, kwds.pop("pool", "dlt"), **kwds)
+        # librados requires bytes, mapped views are copied here
+        data = data if isinstance(data, bytes) else bytes(data)
+        await ioctx.aio_write_full(oid, data)
         
     @trace.info("Ceph.ProtocolService")
     async def read(self, p, oid, size, loop, **kwds):
-        cluster = await self._get_cluster(loop, **kwds)
-        ioctx = cluster.open_ioctx(p)
-        ret = await loop.run_in_executor(None, ioctx.read, oid, size)
-        ioctx.close()
-        return ret
+        # The object's own pool wins over any pool in the depot settings
+        kwds.pop("pool", None)
+        ioctx = await self._get_ioctx(loop, p, **kwds)
+        return await ioctx.aio_read(oid, size, kwds.get("offset", 0))
@@ -0,0 +1,7 @@
+
+
+#####################
+#  Program Options  #
+#####################
+IOCTX_MAXSIZE    = 32
+IOCTX_IDLE       = 60
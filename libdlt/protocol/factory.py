@@ -42,7 +42,7 @@ def buildAllocation(json):
     if isinstance(json, Extent):
         schema = getattr(json, "$schema")
     else:
-        schema = json["schema"]
+        schema = json["schema"] if "schema" in json else json["$schema"]
     return SCHEMA_MAP[schema].buildAllocation(json)
 
 @trace.info("libdlt.factory")
@@ -59,3 +59,12 @@ def makeProxyFromURI(uri):
 @trace.info("libdlt.factory")
 def makeAllocation(data, offset, depot, **kwds):
     return PROTOCOL_MAP[depot.scheme].makeAllocation(data, offset, depot, **kwds)
+
+@trace.info("libdlt.factory")
+async def makeAllocationAsync(data, offset, depot, **kwds):
+    return await PROTOCOL_MAP[depot.scheme].makeAllocationAsync(data, offset, depot, **kwds)
+
+@trace.info("libdlt.factory")
+def shutdown():
+    for proto in PROTOCOL_MAP.values():
+        proto.shutdown()
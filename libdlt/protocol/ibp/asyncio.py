@@ -0,0 +1,278 @@
+import asyncio, socket, time
+
+from collections import defaultdict
+
+from lace import logging
+from lace.logging import trace
+from libdlt.protocol.ibp import flags, services
+from libdlt.protocol.ibp.flags import print_error
+from libdlt.protocol.ibp.exceptions import IBPError
+from libdlt.protocol.ibp.settings import POOL_MAXSIZE, POOL_IDLE
+
+async def _io(aw, timeout):
+    return await (asyncio.wait_for(aw, timeout) if timeout is not None else aw)
+
+class Connection(object):
+    """
+    asyncio stream counterpart of `pool.Connection`.  `request` retries
+    once on a fresh stream if a reused one was dropped by the depot.
+    """
+    def __init__(self, depot):
+        self.endpoint, self.reused = depot.endpoint, False
+        self._addr = (str(depot.host), int(depot.port))
+        self.last_used = time.time()
+
+    async def connect(self, timeout):
+        self._loop = asyncio.get_running_loop()
+        self._reader, self._writer = await _io(asyncio.open_connection(*self._addr), timeout)
+        # A plain handle on the stream's socket lets readinto receive
+        # payloads straight into the caller's buffer
+        self._sock = self._writer.get_extra_info('socket').dup()
+        return self
+
+    @property
+    def healthy(self):
+        return not (self._writer.is_closing() or self._reader.at_eof() or len(self._reader._buffer))
+
+    async def request(self, command, timeout):
+        try:
+            await self.sendall(command, timeout)
+            return await self.readline(timeout)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not self.reused: raise
+            self.reused = False
+            self.close()
+            await self.connect(timeout)
+            await self.sendall(command, timeout)
+            return await self.readline(timeout)
+
+    async def sendall(self, data, timeout):
+        self._writer.write(data)
+        await _io(self._writer.drain(), timeout)
+
+    async def readline(self, timeout):
+        line = await _io(self._reader.readline(), timeout)
+        if not line.endswith(b'\n'): raise ConnectionResetError("Depot closed connection")
+        return line
+
+    async def readinto(self, view, timeout):
+        # Whatever the stream already buffered is taken first, the rest is
+        # received into view with the transport paused so the two never
+        # compete for the socket
+        view, buf = memoryview(view).cast('B'), self._reader._buffer
+        n = min(len(buf), len(view))
+        view[:n] = buf[:n]
+        del buf[:n]
+        if n == len(view): return n
+        if self._reader.at_eof(): raise ConnectionResetError("Depot closed connection")
+        transport = self._writer.transport
+        transport.pause_reading()
+        try:
+            while n < len(view):
+                k = await _io(self._loop.sock_recv_into(self._sock, view[n:]), timeout)
+                if not k: raise ConnectionResetError("Depot closed connection")
+                n += k
+        finally:
+            self._reader._paused = False
+            if not transport.is_closing(): transport.resume_reading()
+        return n
+
+    def close(self):
+        self._sock.close()
+        if not self._loop.is_closed():
+            self._writer.close()
+            return
+        # The stream can no longer be closed through its loop, shutting
+        # the socket down still ends the connection
+        sock = self._writer.get_extra_info('socket')
+        try:
+            if sock is not None: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+
+class ConnectionPool(object):
+    """
+    Per-depot pool of persistent IBP streams.  Streams belong to the event
+    loop that opened them, so idle lists and depot slots are kept per loop
+    and dropped along with the idle streams once that loop has closed.
+    """
+    def __init__(self, maxsize=POOL_MAXSIZE, idle=POOL_IDLE):
+        self._maxsize, self._idle_timeout = maxsize, idle
+        self._loops = {}
+
+    def _purge(self):
+        # Idle streams reference their loop, so a weak mapping would never
+        # let go of it; finished loops are dropped explicitly instead
+        for loop in [l for l in self._loops if l.is_closed()]:
+            idle, _ = self._loops.pop(loop)
+            for conns in idle.values():
+                for conn in conns: conn.close()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._loops: self._purge()
+        if loop not in self._loops:
+            self._loops[loop] = (defaultdict(list), defaultdict(lambda: asyncio.Semaphore(self._maxsize)))
+        return self._loops[loop]
+
+    async def _checkout(self, depot, timeout):
+        idle, _ = self._state()
+        now, conns = time.time(), idle[depot.endpoint]
+        while conns:
+            conn = conns.pop()
+            if conn.healthy and now - conn.last_used <= self._idle_timeout:
+                conn.reused = True
+                return conn
+            conn.close()
+        return await Connection(depot).connect(timeout)
+
+    def _checkin(self, conn):
+        idle, _ = self._state()
+        conn.last_used = time.time()
+        idle[conn.endpoint].append(conn)
+
+    async def run(self, depot, timeout, fn):
+        """
+        Run the coroutine function `fn` with a pooled connection to `depot`.
+        Connections that raise, including on cancellation, are discarded.
+        """
+        _, slots = self._state()
+        slot = slots[depot.endpoint]
+        await _io(slot.acquire(), timeout)
+        try:
+            conn = await self._checkout(depot, timeout)
+            try:
+                result = await fn(conn)
+            except BaseException:
+                conn.close()
+                raise
+            self._checkin(conn)
+            return result
+        finally:
+            slot.release()
+
+    @trace.info("IBP.asyncio.ConnectionPool")
+    def close(self):
+        self._purge()
+        for idle, _ in self._loops.values():
+            for conns in idle.values():
+                for conn in conns: conn.close()
+            idle.clear()
+
+# Streams are shared by every asyncio ProtocolService in the process
+connections = ConnectionPool()
+
+class ProtocolService(services.ProtocolService):
+    """
+    Coroutine implementation of the IBP ProtocolService.  Commands and
+    responses are identical to the blocking service, only the transport
+    differs.
+    """
+    @trace.debug("IBP.asyncio.ProtocolService")
+    def __init__(self, pool=None):
+        self._log = logging.getLogger('libdlt.ibp')
+        self._pool = pool or connections
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def getStatus(self, depot, **kwargs):
+        c = self._status_cmd(**kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            return self._status_result(await self._dispatch_command(depot, c, timeout))
+        except Exception as e:
+            self._log.warn(f"getStatus - Failed @ {depot.host}:{depot.port} - {e}")
+            raise
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def manage(self, alloc, **kwargs):
+        c, depot = self._manage_cmd(alloc, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            return (await self._dispatch_command(depot, c, timeout)).split(" ")
+        except Exception as e:
+            self._log.warn(f"manage: [{alloc.id}] - Failed @ {depot.host}:{depot.port} - {e}")
+            raise
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def probe(self, alloc, **kwargs):
+        return self._probe_result(await self.manage(alloc, mode = flags.IBP_PROBE, **kwargs))
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def allocate(self, depot, offset, size, **kwargs):
+        c = self._allocate_cmd(size, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            r = (await self._dispatch_command(depot, c, timeout)).split(" ")[1:]
+        except Exception as e:
+            self._log.warn(f"allocate: Failed @ {depot.host}:{depot.port} - {e}")
+            raise
+        return self._allocate_result(r, depot, offset, size, **kwargs)
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def store(self, alloc, data, size, **kwargs):
+        c, depot = self._store_cmd(alloc, size, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            return (await self._dispatch_data(depot, c, data, timeout)).split(" ")
+        except Exception as e:
+            self._log.warn(f"store: Failed @ {depot.host}:{depot.port} - {e}")
+            raise
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def send(self, source, destination, **kwargs):
+        c, s_depot = self._send_cmd(source, destination, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            return (await self._dispatch_command(s_depot, c, timeout)).split(" ")
+        except Exception as e:
+            self._log.warn(f"send: Failed @ {s_depot.host}:{s_depot.port} - {e}")
+            raise
+
+    @trace.info("IBP.asyncio.ProtocolService")
+    async def load(self, alloc, buffer=None, **kwargs):
+        c, depot, size = self._load_cmd(alloc, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            data = self._load_buffer(buffer, size)
+            return (await self._receive_data(depot, c, data, timeout=timeout))["data"]
+        except Exception as e:
+            self._log.warn(f"load: Failed @ {depot.host}:{depot.port} - {e}")
+            raise
+
+    @trace.debug("IBP.asyncio.ProtocolService")
+    async def _receive_data(self, depot, command, data, timeout):
+        if isinstance(command, str): command = command.encode()
+
+        async def _f(conn):
+            hdr = await conn.request(command, timeout)
+            if hdr.startswith(b'-'):
+                raise IBPError(print_error(hdr.decode().split(" ")[0]))
+            await conn.readinto(data, timeout)
+            return { "headers": hdr.decode(), "data": data }
+        self._log.debug(f"IBP receive [{depot.host}]: {command}")
+        return await self._pool.run(depot, timeout, _f)
+
+    @trace.debug("IBP.asyncio.ProtocolService")
+    async def _dispatch_data(self, depot, command, data, timeout):
+        if isinstance(command, str): command = command.encode()
+        if isinstance(data, str): data = data.encode()
+
+        async def _f(conn):
+            r = await conn.request(command, timeout)
+            if r.startswith(b'-'):
+                raise IBPError(print_error(r.decode().split(" ")[0]))
+            await conn.sendall(data, timeout)
+            return await conn.readline(timeout)
+        self._log.debug(f"IBP send [{depot.host}]: {command} | size: {len(data)}")
+        return (await self._pool.run(depot, timeout, _f)).decode()
+
+    @trace.debug("IBP.asyncio.ProtocolService")
+    async def _dispatch_command(self, depot, command, timeout):
+        if isinstance(command, str): command = command.encode()
+
+        async def _f(conn):
+            return await conn.request(command, timeout)
+        self._log.debug(f"IBP command [{depot.host}]: {command}")
+        r = (await self._pool.run(depot, timeout, _f)).decode()
+        if r.startswith("-"): raise IBPError(print_error(r.split(" ")[0]))
+        return r
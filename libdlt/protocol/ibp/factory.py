@@ -6,6 +6,7 @@ from libdlt.protocol.exceptions import AllocationError
 from libdlt.protocol.ibp.allocation import IBPExtent
 from libdlt.depot import Depot
 import libdlt.protocol.ibp.services as services
+import libdlt.protocol.ibp.asyncio as aioservices
 import libdlt.protocol.ibp.flags as flags
 
 from lace import logging
@@ -41,12 +42,30 @@ def makeAllocation(data, offset, depot, **kwds):
         return IBPAdaptor(data=data, offset=offset, depot=depot, **kwds)
     except:
         raise AllocationError("Failed to generate allocation")
+
+# create a new object and metadata without blocking the event loop
+@trace.info("libdlt.IBP.factory")
+async def makeAllocationAsync(data, offset, depot, **kwds):
+    service = aioservices.ProtocolService()
+    try:
+        alloc = await service.allocate(depot, offset, len(data), **kwds)
+        await service.store(alloc, data, len(data), **kwds)
+    except:
+        raise AllocationError("Failed to generate allocation")
+    return IBPAdaptor(alloc)
     
+# release pooled depot connections
+@trace.info("libdlt.IBP.factory")
+def shutdown():
+    services.connections.close()
+    aioservices.connections.close()
+
 class IBPAdaptor(object):
     @trace.debug("libdlt.IBPAdaptor")
     def __init__(self, alloc=None, data=None, offset=None, depot=None, **kwds):
         self.log = logging.getLogger("libdlt")
         self._service = services.ProtocolService()
+        self._aservice = aioservices.ProtocolService()
 
         if data:
             self._allocation = self._service.allocate(depot, offset, len(data), **kwds)
@@ -62,6 +81,10 @@ class IBPAdaptor(object):
     def read(self, **kwds):
         return self._service.load(self._allocation, **kwds)
         
+    @trace.info("libdlt.IBPAdaptor")
+    async def aread(self, **kwds):
+        return await self._aservice.load(self._allocation, **kwds)
+        
     @trace.info("libdlt.IBPAdaptor")
     def write(self, data, **kwds):
         try:
@@ -89,35 +112,29 @@ class IBPAdaptor(object):
         
         return True
         
+    def _copy_args(self, src_kwargs, dst_kwargs, **kwds):
+        offset = kwds.get("offset", 0)
+        size   = kwds.get("size", None) or self._allocation.size - offset
+        dst_kwds = {k: v for k, v in {**dst_kwargs, **kwds}.items() if k not in ("offset", "size")}
+        return offset, size, dst_kwds, {**src_kwargs, **kwds, "offset": offset, "size": size}
+
     @trace.info("libdlt.IBPAdaptor")
     def copy(self, destination, src_kwargs, dst_kwargs, **kwds):
-        host   = self._allocation.depot.host
-        port   = self._allocation.depot.port
-        offset = kwds.get("offset", 0)
-        size   = kwds.get("size", self._allocation.depotSize - offset)
-        
-        dest_alloc = buildAllocation(self._allocation.to_JSON())
-        
-        response = self._service.allocate(destination, size, **kwds)
-        if not response:
-            return False
-        
-        dest_alloc._allocation.setReadCapability(str(response.getReadCapability()))
-        dest_alloc._allocation.setWriteCapability(str(response.getWriteCapability()))
-        dest_alloc._allocation.setManageCapability(str(response.getManageCapability()))
-        dest_alloc._allocation.depot = response.depot
-        dest_alloc._allocation.location = response.location
-        dest_alloc.offset = offset
-        del dest_alloc._allocation.function
-        duration = self._service.send(self._allocation, dest_alloc, **kwds)
-        
-        if not duration:
-            return False
-        
-        dest_alloc._allocation.start = datetime.datetime.utcnow()
-        dest_alloc._allocation.end = datetime.datetime.utcnow() + datetime.timedelta(seconds = duration)
-        
-        return dest_alloc
+        """
+        Replicate the allocation onto the depot `destination` with a
+        third-party IBP_SEND, the data never passes through this host.
+        """
+        offset, size, dst_kwds, src_kwds = self._copy_args(src_kwargs, dst_kwargs, **kwds)
+        dest = self._service.allocate(destination, self._allocation.offset + offset, size, **dst_kwds)
+        self._service.send(self._allocation, dest, **src_kwds)
+        return IBPAdaptor(dest)
+
+    @trace.info("libdlt.IBPAdaptor")
+    async def acopy(self, destination, src_kwargs, dst_kwargs, **kwds):
+        offset, size, dst_kwds, src_kwds = self._copy_args(src_kwargs, dst_kwargs, **kwds)
+        dest = await self._aservice.allocate(destination, self._allocation.offset + offset, size, **dst_kwds)
+        await self._aservice.send(self._allocation, dest, **src_kwds)
+        return IBPAdaptor(dest)
         
     @trace.info("libdlt.IBPAdaptor")
     def move(self, destination, **kwds):
@@ -0,0 +1,154 @@
+import select, socket, threading, time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from lace import logging
+from lace.logging import trace
+from libdlt.protocol.ibp.settings import POOL_MAXSIZE, POOL_IDLE
+
+class Connection(object):
+    """
+    A single depot socket with a small receive buffer.  IBP responses
+    are newline terminated, so the buffer holds any bytes read past the
+    end of a header line until the next call consumes them.
+    """
+    def __init__(self, depot, timeout):
+        self.endpoint, self.reused = depot.endpoint, False
+        self._addr = (str(depot.host), int(depot.port))
+        self._buf = bytearray()
+        self.last_used = time.time()
+        self._connect(timeout)
+
+    def _connect(self, timeout):
+        self._sock = socket.create_connection(self._addr, timeout)
+        self._sock.settimeout(timeout)
+        self._buf.clear()
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    @property
+    def healthy(self):
+        # An idle IBP connection should never have pending data, a readable
+        # socket means the depot closed it or left garbage in the stream.
+        if self._buf: return False
+        try:
+            r, _, _ = select.select([self._sock], [], [], 0)
+        except (OSError, ValueError): return False
+        return not r
+
+    def request(self, command):
+        """
+        Send a command and return the response line.  A reused socket may
+        have been dropped by the depot while idle, in which case the command
+        is retried once on a fresh socket.
+        """
+        try:
+            self._sock.sendall(command)
+            return self.readline()
+        except (ConnectionError, BrokenPipeError):
+            if not self.reused: raise
+            self.reused, timeout = False, self._sock.gettimeout()
+            self._sock.close()
+            self._connect(timeout)
+            self._sock.sendall(command)
+            return self.readline()
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+
+    def readline(self):
+        while b'\n' not in self._buf:
+            chunk = self._sock.recv(4096)
+            if not chunk: raise ConnectionResetError("Depot closed connection")
+            self._buf += chunk
+        line = self._buf.index(b'\n') + 1
+        result = bytes(self._buf[:line])
+        del self._buf[:line]
+        return result
+
+    def readinto(self, view):
+        """
+        Fill the writable buffer `view` completely, copying each byte from
+        the socket exactly once.
+        """
+        view = memoryview(view).cast('B')
+        n = min(len(self._buf), len(view))
+        view[:n] = self._buf[:n]
+        del self._buf[:n]
+        while n < len(view):
+            r = self._sock.recv_into(view[n:])
+            if not r: raise ConnectionResetError("Depot closed connection")
+            n += r
+        return n
+
+    def close(self):
+        try: self._sock.close()
+        except OSError: pass
+
+
+class ConnectionPool(object):
+    """
+    Per-depot pool of persistent IBP connections keyed by depot endpoint.
+    At most `maxsize` sockets are open to any one depot, sockets idle for
+    longer than `idle` seconds are closed, and idle sockets are health
+    checked before they are handed out again.
+    """
+    def __init__(self, maxsize=POOL_MAXSIZE, idle=POOL_IDLE):
+        self._log = logging.getLogger('libdlt.ibp')
+        self._maxsize, self._idle_timeout = maxsize, idle
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+        self._slots = defaultdict(lambda: threading.BoundedSemaphore(self._maxsize))
+
+    def _evict(self, now):
+        # Caller must hold self._lock
+        for endpoint, conns in self._idle.items():
+            stale = [c for c in conns if now - c.last_used > self._idle_timeout]
+            for conn in stale:
+                self._log.debug(f"Evicting idle connection to {endpoint}")
+                conns.remove(conn)
+                conn.close()
+
+    def _checkout(self, depot, timeout):
+        with self._lock:
+            self._evict(time.time())
+            conns = self._idle[depot.endpoint]
+            while conns:
+                conn = conns.pop()
+                if conn.healthy:
+                    conn.reused = True
+                    conn.settimeout(timeout)
+                    return conn
+                conn.close()
+        return Connection(depot, timeout)
+
+    def _checkin(self, conn):
+        conn.last_used = time.time()
+        with self._lock:
+            self._idle[conn.endpoint].append(conn)
+
+    @contextmanager
+    def connection(self, depot, timeout=None):
+        with self._lock:
+            slots = self._slots[depot.endpoint]
+        if not (slots.acquire() if timeout is None else slots.acquire(timeout=timeout)):
+            raise socket.timeout(f"No connection available to {depot.endpoint}")
+        try:
+            conn = self._checkout(depot, timeout)
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            self._checkin(conn)
+        finally:
+            slots.release()
+
+    @trace.info("IBP.ConnectionPool")
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns: conn.close()
+            self._idle.clear()
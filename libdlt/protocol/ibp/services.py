@@ -10,7 +10,7 @@ to the IBP protocol
 
 '''
 
-import time, socket
+import time
 from math import ceil
 
 from libdlt.protocol.ibp.settings import DEFAULT_PASSWORD, DEFAULT_TIMEOUT, DEFAULT_DURATION, DEFAULT_MAXSIZE
@@ -20,8 +20,12 @@ from libdlt.protocol.exceptions import AllocationError
 from libdlt.protocol.ibp import flags, allocation
 from libdlt.protocol.ibp.flags import print_error
 from libdlt.protocol.ibp.exceptions import IBPError
+from libdlt.protocol.ibp.pool import ConnectionPool
 from libdlt.depot import Depot
 
+# Connections are shared by every ProtocolService in the process
+connections = ConnectionPool()
+
 class Capability(object):
     def __init__(self, cap_string):
         try:
@@ -43,41 +47,24 @@ class Capability(object):
 
 class ProtocolService(object):
     @trace.debug("IBP.ProtocolService")
-    def __init__(self):
+    def __init__(self, pool=None):
         self._log = logging.getLogger('libdlt.ibp')
+        self._pool = pool or connections
 
     
     @trace.info("IBP.ProtocolService")
     def getStatus(self, depot, **kwargs):
-        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
-
-        # Query the status of a Depot.
-        # IBPv031[0] IBP_ST_INQ[2] pwd timeout
-        c = f"{flags.IBPv031} {flags.IBP_STATUS} {flags.IBP_ST_INQ} " \
-            f"{kwargs.get('password', DEFAULT_PASSWORD)} {timeout} \n"
+        c = self._status_cmd(**kwargs)
         try:
             timeout = kwargs.get('timeout', None)
-            return dict(zip(["total", "used", "volatile", "used-volatile", "max-duration"],
-                            self._dispatch_command(depot, c, timeout).split(" ")))
+            return self._status_result(self._dispatch_command(depot, c, timeout))
         except Exception as e:
             self._log.warn(f"getStatus - Failed @ {depot.host}:{depot.port} - {e}")
             raise
 
     @trace.info("IBP.ProtocolService")
     def manage(self, alloc, **kwargs):
-        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
-        try:
-            cap, depot = Capability(alloc.mapping.manage), Depot(alloc.location)
-        except AttributeError:
-            raise AllocationError("Incomplete allocation")
-
-        # Generate manage request with the following form
-        # IBPv031[0] IBP_MANAGE[9] manage_key "MANAGE" IBP_CHANGE[43] cap_type max_size duration reliability timeout
-        c = f"{flags.IBPv031} {flags.IBP_MANAGE} {cap.key} {cap.code} " \
-            f"{kwargs.get('mode', flags.IBP_CHANGE)} {kwargs.get('cap_type', 0)} " \
-            f"{kwargs.get('max_size', DEFAULT_MAXSIZE)} " \
-            f"{kwargs.get('duration', DEFAULT_DURATION)} " \
-            f"{kwargs.get('reliability', flags.IBP_HARD)} {timeout} \n"
+        c, depot = self._manage_cmd(alloc, **kwargs)
         try:
             timeout = kwargs.get('timeout', None)
             return self._dispatch_command(depot, c, timeout).split(" ")
@@ -87,49 +74,22 @@ class ProtocolService(object):
 
     @trace.info("IBP.ProtocolService")
     def probe(self, alloc, **kwargs):
-        return dict(zip(["read_count","write_count","size","max_size",
-                         "duration","reliability","type"],
-                        self.manage(alloc, mode = flags.IBP_PROBE, **kwargs)[1:]))
+        return self._probe_result(self.manage(alloc, mode = flags.IBP_PROBE, **kwargs))
 
     @trace.info("IBP.ProtocolService")
     def allocate(self, depot, offset, size, **kwargs):
-        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
-        duration = kwargs.get('duration', None) or DEFAULT_DURATION
-        
-        # Generate destination Allocation and Capabilities using the form below
-        # IBPv031[0] IBP_ALLOCATE[1] reliability cap_type duration size timeout
-        c = f"{flags.IBPv031} {flags.IBP_ALLOCATE} " \
-            f"{kwargs.get('reliability', flags.IBP_HARD)} " \
-            f"{kwargs.get('cap_type', flags.IBP_BYTEARRAY)} {duration} {size} {timeout} \n"
+        c = self._allocate_cmd(size, **kwargs)
         try:
             timeout = kwargs.get('timeout', None)
             r = self._dispatch_command(depot, c, timeout).split(" ")[1:]
         except Exception as e:
             self._log.warn(f"allocate: Failed @ {depot.host}:{depot.port} - {e}")
             raise
-
-        try:
-            alloc = allocation.IBPExtent()
-            alloc.mapping = dict(zip(["read", "write", "manage"],
-                                     [v.replace("0.0.0.0", str(depot.host)) for v in r]))
-            alloc.lifetime = { 'start': str(int(time.time() * 1000000)),
-                               'end':  str(int((time.time() + duration) * 1000000)) }
-            alloc.location = depot.endpoint
-            alloc.offset = alloc.alloc_offset = offset
-            alloc.size = alloc.alloc_length = size
-        except:
-            raise
-        return alloc
+        return self._allocate_result(r, depot, offset, size, **kwargs)
     
     @trace.info("IBP.ProtocolService")
     def store(self, alloc, data, size, **kwargs):
-        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
-        try:
-            cap, depot = Capability(alloc.mapping.write), Depot(alloc.location)
-        except AttributeError:
-            raise AllocationError("Incomplete allocation")
-        # IBPv031[0] IBP_STORE[2] write_key WRMKey size timeout
-        c = f"{flags.IBPv031} {flags.IBP_STORE} {cap.key} {cap.wrmKey} {size} {timeout}\n"
+        c, depot = self._store_cmd(alloc, size, **kwargs)
         try:
             timeout = kwargs.get('timeout', None)
             return self._dispatch_data(depot, c, data, timeout).split(" ")
@@ -139,6 +99,96 @@ class ProtocolService(object):
 
     @trace.info("IBP.ProtocolService")
     def send(self, source, destination, **kwargs):
+        c, s_depot = self._send_cmd(source, destination, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            return self._dispatch_command(s_depot, c, timeout).split(" ")
+        except Exception as e:
+            self._log.warn(f"send: Failed @ {s_depot.host}:{s_depot.port} - {e}")
+            raise
+
+    @trace.info("IBP.ProtocolService")
+    def load(self, alloc, buffer=None, **kwargs):
+        c, depot, size = self._load_cmd(alloc, **kwargs)
+        try:
+            timeout = kwargs.get('timeout', None)
+            data = self._load_buffer(buffer, size)
+            return self._receive_data(depot, c, data, timeout=timeout)["data"]
+        except Exception as e:
+            self._log.warn(f"load: Failed @ {depot.host}:{depot.port} - {e}")
+            raise
+
+    def _load_buffer(self, buffer, size):
+        # Loads are received directly into the caller's buffer when one is
+        # given, such as a slice of a shared buffer or of a mapped file.
+        if buffer is None: return bytearray(size)
+        view = memoryview(buffer)
+        if view.nbytes < size:
+            raise ValueError(f"Buffer too small for allocation [{view.nbytes} < {size}]")
+        return view.cast('B')[:size]
+
+    def _status_cmd(self, **kwargs):
+        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
+
+        # Query the status of a Depot.
+        # IBPv031[0] IBP_ST_INQ[2] pwd timeout
+        return f"{flags.IBPv031} {flags.IBP_STATUS} {flags.IBP_ST_INQ} " \
+            f"{kwargs.get('password', DEFAULT_PASSWORD)} {timeout} \n"
+
+    def _status_result(self, r):
+        return dict(zip(["total", "used", "volatile", "used-volatile", "max-duration"], r.split(" ")))
+
+    def _manage_cmd(self, alloc, **kwargs):
+        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
+        try:
+            cap, depot = Capability(alloc.mapping.manage), Depot(alloc.location)
+        except AttributeError:
+            raise AllocationError("Incomplete allocation")
+
+        # Generate manage request with the following form
+        # IBPv031[0] IBP_MANAGE[9] manage_key "MANAGE" IBP_CHANGE[43] cap_type max_size duration reliability timeout
+        return f"{flags.IBPv031} {flags.IBP_MANAGE} {cap.key} {cap.code} " \
+            f"{kwargs.get('mode', flags.IBP_CHANGE)} {kwargs.get('cap_type', 0)} " \
+            f"{kwargs.get('max_size', DEFAULT_MAXSIZE)} " \
+            f"{kwargs.get('duration', DEFAULT_DURATION)} " \
+            f"{kwargs.get('reliability', flags.IBP_HARD)} {timeout} \n", depot
+
+    def _probe_result(self, r):
+        return dict(zip(["read_count","write_count","size","max_size",
+                         "duration","reliability","type"], r[1:]))
+
+    def _allocate_cmd(self, size, **kwargs):
+        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
+        duration = kwargs.get('duration', None) or DEFAULT_DURATION
+        
+        # Generate destination Allocation and Capabilities using the form below
+        # IBPv031[0] IBP_ALLOCATE[1] reliability cap_type duration size timeout
+        return f"{flags.IBPv031} {flags.IBP_ALLOCATE} " \
+            f"{kwargs.get('reliability', flags.IBP_HARD)} " \
+            f"{kwargs.get('cap_type', flags.IBP_BYTEARRAY)} {duration} {size} {timeout} \n"
+
+    def _allocate_result(self, r, depot, offset, size, **kwargs):
+        duration = kwargs.get('duration', None) or DEFAULT_DURATION
+        alloc = allocation.IBPExtent()
+        alloc.mapping = dict(zip(["read", "write", "manage"],
+                                 [v.replace("0.0.0.0", str(depot.host)) for v in r]))
+        alloc.lifetime = { 'start': str(int(time.time() * 1000000)),
+                           'end':  str(int((time.time() + duration) * 1000000)) }
+        alloc.location = depot.endpoint
+        alloc.offset = alloc.alloc_offset = offset
+        alloc.size = alloc.alloc_length = size
+        return alloc
+
+    def _store_cmd(self, alloc, size, **kwargs):
+        timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
+        try:
+            cap, depot = Capability(alloc.mapping.write), Depot(alloc.location)
+        except AttributeError:
+            raise AllocationError("Incomplete allocation")
+        # IBPv031[0] IBP_STORE[2] write_key WRMKey size timeout
+        return f"{flags.IBPv031} {flags.IBP_STORE} {cap.key} {cap.wrmKey} {size} {timeout}\n", depot
+
+    def _send_cmd(self, source, destination, **kwargs):
         timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
         size = kwargs.get("size", None) or source.size
         try:
@@ -147,53 +197,34 @@ class ProtocolService(object):
         except AttributeError:
             raise AllocationError("Incomplete allocation")
         # IBPv040[1] IBP_SEND[5] src_read_key dest_write_cap src_WRMKey offset size timeout timeout timeout
-        c = f"{flags.IBPv040} {flags.IBP_SEND} {s_cap.key} {str(d_cap)} {s_cap.wrmKey} " \
-            f"{kwargs.get('offset', 0)} {size} {timeout} {timeout} {timeout}\n "
+        return f"{flags.IBPv040} {flags.IBP_SEND} {s_cap.key} {str(d_cap)} {s_cap.wrmKey} " \
+            f"{kwargs.get('offset', 0)} {size} {timeout} {timeout} {timeout}\n", s_depot
 
-    # Generate move request with the following form
-        try:
-            timeout = kwargs.get('timeout', None)
-            return self._dispatch_command(s_depot, c, timeout).split(" ")
-        except Exception as e:
-            self._log.warn(f"send: Failed @ {s_depot.host}:{s_depot.port} - {e}")
-            raise
-
-    @trace.info("IBP.ProtocolService")
-    def load(self, alloc, **kwargs):
+    def _load_cmd(self, alloc, **kwargs):
         timeout = kwargs.get('timeout', None) or DEFAULT_TIMEOUT
         try:
             cap, depot = Capability(alloc.mapping.read), Depot(alloc.location)
         except AttributeError:
             raise AllocationError("Incomplete allocation")
-        c = f"{flags.IBPv031} {flags.IBP_LOAD} {cap.key} {cap.wrmKey} " \
-            f"{kwargs.get('offset', 0)} {alloc.size} " \
-            f"{kwargs.get('timeout', DEFAULT_TIMEOUT)} \n"
-        try:
-            timeout = kwargs.get('timeout', None)
-            return self._receive_data(depot, c, alloc.size, timeout=timeout)["data"]
-        except Exception as e:
-            self._log.warn(f"load: Failed @ {depot.host}:{depot.port} - {e}")
-            raise
+        # Loads may cover any byte range within the allocation
+        offset = kwargs.get('offset', None) or 0
+        size = kwargs.get('size', None) or alloc.size - offset
+        if offset < 0 or offset + size > alloc.size:
+            raise ValueError(f"Range {offset}-{offset+size} outside allocation of size {alloc.size}")
+        # IBPv031[0] IBP_LOAD[8] read_key WRMKey offset size timeout
+        return f"{flags.IBPv031} {flags.IBP_LOAD} {cap.key} {cap.wrmKey} " \
+            f"{offset} {size} {timeout} \n", depot, size
 
     @trace.debug("IBP.ProtocolService")
-    def _receive_data(self, depot, command, size, timeout):
+    def _receive_data(self, depot, command, data, timeout):
         if isinstance(command, str): command = command.encode()
 
         self._log.debug(f"IBP receive [{depot.host}]: {command}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(timeout)
-            s.connect((str(depot.host), depot.port))
-            s.sendall(command)
-            buf = s.recv(1024)
-            try:
-                line = buf.index(b'\n') + 1
-                hdr, data = buf[:line], buf[line:]
-            except ValueError: data = b''
+        with self._pool.connection(depot, timeout) as conn:
+            hdr = conn.request(command)
             if hdr.startswith(b'-'):
-                if isinstance(hdr, bytes): hdr = hdr.decode()
-                raise IBPError(print_error(r.split(" ")[0]))
-            while len(data) < size:
-                data += s.recv(size - len(data))
+                raise IBPError(print_error(hdr.decode().split(" ")[0]))
+            conn.readinto(data)
 
         return { "headers": hdr.decode(), "data": data }
 
@@ -203,16 +234,12 @@ class ProtocolService(object):
         if isinstance(data, str): data = data.encode()
 
         self._log.debug(f"IBP send [{depot.host}]: {command} | size: {len(data)}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(timeout)
-            s.connect((str(depot.host), depot.port))
-            s.sendall(command)
-            r = s.recv(1024)
+        with self._pool.connection(depot, timeout) as conn:
+            r = conn.request(command)
             if r.startswith(b'-'):
-                if isinstance(r, bytes): r = r.decode()
-                raise IBPError(print_error(r.split(" ")[0]))
-            s.sendall(data)
-            r = s.recv(1024)
+                raise IBPError(print_error(r.decode().split(" ")[0]))
+            conn.sendall(data)
+            r = conn.readline()
         if isinstance(r, bytes): r = r.decode()
         return r
 
@@ -221,11 +248,8 @@ class ProtocolService(object):
         if isinstance(command, str): command = command.encode()
 
         self._log.debug(f"IBP command [{depot.host}]: {command}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(timeout)
-            s.connect((str(depot.host), int(depot.port)))
-            s.sendall(command)
-            r = s.recv(1024)
+        with self._pool.connection(depot, timeout) as conn:
+            r = conn.request(command)
             if isinstance(r, bytes): r = r.decode()
 
         if r.startswith("-"): raise IBPError(print_error(r.split(" ")[0]))
@@ -9,3 +9,5 @@ DEFAULT_TIMEOUT  = 0.5
 DEFAULT_MAXSIZE  = 1024 * 1024 * 10
 DEFAULT_PORT     = 6714
 
+POOL_MAXSIZE     = 16
+POOL_IDLE        = 30
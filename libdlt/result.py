@@ -2,4 +2,7 @@
 from collections import namedtuple
 
 GenericTransactionResult = namedtuple('GenericTransactionResult', ['time', 't_size', 'exnode'])
-UploadResult = DownloadResult = CopyResult = GenericTransactionResult
+CopyResult = GenericTransactionResult
+UploadResult = namedtuple('UploadResult', GenericTransactionResult._fields + ('md_time',), defaults=(0,))
+DownloadResult = namedtuple('DownloadResult', GenericTransactionResult._fields + ('hedged', 'hedge_wins'),
+                            defaults=(0, 0))
@@ -3,6 +3,8 @@ import abc
 from collections import defaultdict
 from itertools import cycle
 from lace.logging import trace
+from libdlt.depot import Depot
+from libdlt.util.files import ExtentIndex
 
 
 DOWNLOAD_RETRY = 3
@@ -26,6 +28,15 @@ class AbstractSchedule(metaclass=abc.ABCMeta):
         offset.
         """
         pass
+
+    def complete(self, context):
+        """
+        complete is called once a value emitted by get
+        has been used.  context contains the "alloc" and
+        "offset" of the transfer along with either its
+        "size" and "time" or the "error" that ended it.
+        """
+        pass
     
 
 class BaseUploadSchedule(AbstractSchedule):
@@ -47,29 +58,123 @@ class BaseUploadSchedule(AbstractSchedule):
 class BaseDownloadSchedule(AbstractSchedule):
     @trace.info("BaseDownloadSchedule")
     def setSource(self, source):
-        chunks = defaultdict(list)
-        for ext in source:
-            chunks[ext.offset].append({"retry": 0, "alloc": ext})
-        self._ls = chunks
+        self._ls = ExtentIndex([{"retry": 0, "alloc": ext} for ext in source], key=lambda c: c['alloc'])
         
     @trace.info("BaseDownloadSchedule")
     def get(self, context={}):
         offset = context["offset"]
-        if offset in self._ls and self._ls[offset]:
-            chunk = self._ls[offset].pop()
-            if chunk['retry'] < DOWNLOAD_RETRY:
-                chunk['retry'] += 1
-                self._ls[offset].insert(0, chunk)
-            return chunk['alloc']
-        else:
-            chunk = None
-            for k, chunk in self._ls.items():
-                if k < offset:
-                    for i, ext in enumerate(chunk):
-                        if ext['alloc'].size + ext['alloc'].offset > offset:
-                            chunk = self._ls[k].pop(i)
-                            if chunk['retry'] < DOWNLOAD_RETRY:
-                                chunk['retry'] += 1
-                                self._ls[k].insert(0, chunk)
-                            return ext['alloc']
+        candidates = []
+        for _, chunks in self._ls.buckets(offset):
+            for i, chunk in enumerate(chunks):
+                if chunk['alloc'].offset + chunk['alloc'].size > offset:
+                    candidates.append((chunks, i))
+        if not candidates:
             raise IndexError("No more allocations fulfill request: offset ~ {}".format(offset))
+
+        chunks, i = self._choose(offset, candidates)
+        chunk = chunks.pop(i)
+        if chunk['retry'] < DOWNLOAD_RETRY:
+            chunk['retry'] += 1
+            chunks.insert(0, chunk)
+        return chunk['alloc']
+
+    def _choose(self, offset, candidates):
+        """
+        Select one of the (chunk list, index) pairs covering offset.
+        Replicas starting exactly at offset are preferred, rotating
+        through them as they are retried.
+        """
+        for chunks, i in reversed(candidates):
+            if chunks[i]['alloc'].offset == offset:
+                return chunks, i
+        return candidates[0]
+
+
+class ThroughputDownloadSchedule(BaseDownloadSchedule):
+    """
+    Sends each block to the replica expected to finish it first, taking
+    latency + (in flight + 1) * size / bw for each depot.  Latency and
+    throughput come from a moving least-squares fit of block time against
+    block size, so bandwidth is measured net of latency.  Until a depot
+    has served blocks of differing sizes the two cannot be told apart and
+    its whole block time counts as transfer.
+    """
+    def __init__(self, alpha=0.3):
+        self._alpha = alpha
+        self._stats = defaultdict(lambda: {"bw": None, "latency": None, "active": 0, "errors": 0, "fit": {}})
+
+    def _ewma(self, prev, v):
+        return v if prev is None else (1 - self._alpha) * prev + self._alpha * v
+
+    def _fit(self, stat):
+        fit = stat["fit"]
+        var = fit["ss"] - fit["s"] ** 2
+        slope = (fit["st"] - fit["s"] * fit["t"]) / var if var > 1e-6 * fit["ss"] else 0
+        if slope > 0:
+            stat["bw"], stat["latency"] = 1 / slope, max(0, fit["t"] - slope * fit["s"])
+        elif fit["t"] > 0:
+            stat["bw"], stat["latency"] = fit["s"] / fit["t"], 0
+
+    def _expected(self, alloc):
+        stat = self._stats[Depot(alloc.location).endpoint]
+        # Depots not yet measured are tried first, or the schedule would
+        # never learn whether they are faster than the ones it knows
+        if stat["bw"] is None and not stat["active"] and not stat["errors"]: return 0
+        bw = stat["bw"] or max([v["bw"] for v in self._stats.values() if v["bw"]], default=None)
+        if not bw: return stat["active"]
+        return (stat["latency"] or 0) + (stat["active"] + 1) * alloc.size / bw
+
+    def _choose(self, offset, candidates):
+        return min(candidates, key=lambda c: self._expected(c[0][c[1]]['alloc']))
+
+    @trace.info("ThroughputDownloadSchedule")
+    def get(self, context={}):
+        alloc = super().get(context)
+        self._stats[Depot(alloc.location).endpoint]["active"] += 1
+        return alloc
+
+    @trace.info("ThroughputDownloadSchedule")
+    def complete(self, context):
+        stat = self._stats[Depot(context["alloc"].location).endpoint]
+        stat["active"] = max(0, stat["active"] - 1)
+        fit = stat["fit"]
+        if context.get("error", None) is not None:
+            stat["errors"] += 1
+            # Count failures as blocks taking twice as long
+            if fit:
+                fit["t"], fit["st"] = fit["t"] * 2, fit["st"] * 2
+                self._fit(stat)
+        elif context.get("time", 0) > 0:
+            size, t = context["size"], context["time"]
+            for k, v in (("s", size), ("t", t), ("ss", size * size), ("st", size * t)):
+                fit[k] = self._ewma(fit.get(k, None), v)
+            self._fit(stat)
+
+    def stats(self):
+        return {k: {n: v[n] for n in ("bw", "latency", "active", "errors")} for k, v in self._stats.items()}
+
+
+class StripedDownloadSchedule(AbstractSchedule):
+    """
+    Follows a plan from `ExnodeInfo.plan_striped`.  The first request for
+    the start of a planned piece returns the extent the plan assigned it,
+    any other request, such as a retry after an error, is passed on to
+    `schedule`.  Completions are always passed on so the fallback keeps
+    learning from the planned transfers.
+    """
+    def __init__(self, plan, schedule=None):
+        self._planned = {lo: alloc for work in plan.values() for alloc, lo, _ in work}
+        self._schedule = schedule or BaseDownloadSchedule()
+
+    @trace.info("StripedDownloadSchedule")
+    def setSource(self, source):
+        self._schedule.setSource(source)
+
+    @trace.info("StripedDownloadSchedule")
+    def get(self, context={}):
+        alloc = self._planned.pop(context["offset"], None)
+        return alloc if alloc is not None else self._schedule.get(context)
+
+    @trace.info("StripedDownloadSchedule")
+    def complete(self, context):
+        self._schedule.complete(context)
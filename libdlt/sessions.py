@@ -7,9 +7,9 @@ import time
 import types
 import uuid
 
-from functools import partial
+from collections import Counter, defaultdict, deque
 from itertools import cycle
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from uritools import urisplit
 from socketIO_client import SocketIO
 
@@ -17,16 +17,35 @@ from lace import logging
 from lace.logging import trace
 
 from libdlt.util import util
+from libdlt.util.files import DownloadSink, ExnodeInfo, ExtentIndex, UploadSource
 from libdlt.depot import Depot
+from libdlt.journal import TransferJournal
 from libdlt.protocol import factory
 from libdlt.protocol.exceptions import AllocationError
-from libdlt.schedule import BaseDownloadSchedule, BaseUploadSchedule
-from libdlt.settings import DEPOT_TYPES, THREADS, COPIES, BLOCKSIZE, TIMEOUT
+from libdlt.schedule import BaseDownloadSchedule, BaseUploadSchedule, StripedDownloadSchedule
+from libdlt.settings import DEPOT_TYPES, THREADS, COPIES, BLOCKSIZE, TIMEOUT, HEDGE_PERCENTILE, HEDGE_SAMPLES, MD_BATCH
 from libdlt.result import UploadResult, DownloadResult, CopyResult
 from unis.models import Exnode, Service
 from unis.runtime import Runtime
 from unis.utils.asynchronous import make_async
 
+class _Hedge(object):
+    """
+    Tracks the per-byte latency of completed block reads and derives the
+    deadline after which a read is hedged on another replica.
+    """
+    def __init__(self, percentile, samples=HEDGE_SAMPLES):
+        self.percentile, self.fired, self.won = percentile, 0, 0
+        self._min, self._samples = samples, deque(maxlen=1024)
+
+    def record(self, size, elapsed):
+        if size: self._samples.append(elapsed / size)
+
+    def deadline(self, size):
+        if len(self._samples) < self._min: return None
+        s = sorted(self._samples)
+        return s[min(len(s) - 1, int(len(s) * self.percentile / 100))] * size
+
 class Session(object):
     __WS_MTYPE = {
         'r' : 'peri_download_register',
@@ -57,6 +76,7 @@ class Session(object):
         self._depots = {}
         self._threads = threads
         self._viz = kwargs.get("viz_url", None)
+        self._md_batch = kwargs.get("md_batch", MD_BATCH)
         self._jobs = asyncio.Queue()
         self.log = logging.getLogger('libdlt')
         self._record = []
@@ -121,51 +141,183 @@ class Session(object):
             pass
 
     @trace.debug("Session")
-    def _generate_jobs(self, step, size, copies):
+    def _generate_jobs(self, step, size, copies, done={}, fanout=False):
+        # Jobs are (offset, size, replicas to fan out once uploaded).  Each
+        # transfer starts from an empty queue, an interrupted one may have
+        # left jobs behind
+        self._jobs = asyncio.Queue()
         for chunk in range(0, size, step):
-            for _ in range(copies):
-                self._jobs.put_nowait((chunk, step))
+            if fanout and not done.get(chunk, 0):
+                self._jobs.put_nowait((chunk, step, copies - 1))
+                continue
+            for _ in range(copies - done.get(chunk, 0)):
+                self._jobs.put_nowait((chunk, step, 0))
+
+    @trace.debug("Session")
+    def _resume_upload(self, journal):
+        allocs, now = [], time.time() * 1000000
+        for entry in journal.entries():
+            end = entry["alloc"].get("lifetime", {}).get("end", None)
+            if end is not None and int(end) <= now:
+                continue
+            try:
+                allocs.append(factory.buildAllocation(entry["alloc"]).getMetadata())
+            except Exception as exp:
+                self.log.warn("Unable to restore staged allocation - {}".format(exp))
+        self.log.info("Resuming upload with {} staged allocations".format(len(allocs)))
+        return allocs
+
+    @trace.debug("Session")
+    def _resume_download(self, journal, start, stop):
+        done = sorted((e["lo"], e["hi"]) for e in journal.entries())
+        gaps, offset = [], start
+        for lo, hi in done:
+            if lo > offset: gaps.append((offset, min(lo, stop)))
+            offset = max(offset, hi)
+        if offset < stop: gaps.append((offset, stop))
+        self.log.info("Resuming download with {} bytes remaining".format(sum(hi - lo for lo, hi in gaps)))
+        return gaps
     
     @trace.debug("Session")
-    async def _upload_chunks(self, path, schedule, duration, sock, rank, progress_cb):
+    async def _upload_chunks(self, source, schedule, duration, sock, rank, progress_cb, journal=None,
+                             published=None, slots=None):
+        def _landed(alloc, rsize):
+            if journal: journal.record(offset=alloc.offset, size=rsize, alloc=alloc.to_JSON())
+            self._record.append(('U', alloc, alloc.offset, rsize))
+            self._viz_progress(sock, alloc.location, alloc.size, alloc.offset, progress_cb)
+            if published is not None: published.put_nowait(alloc)
+            else: allocs.append(alloc)
+
         uploaded = 0
-        allocs = []
-        with open(path, 'rb') as fh:
-            while not self._jobs.empty():
-                offset, size = await self._jobs.get()
-                fh.seek(offset)
-                data = await asyncio.get_event_loop().run_in_executor(None, fh.read, size)
-                rsize = len(data)
-                
-                ## Upload chunk ##
-                try:
-                    d = Depot(schedule.get({"offset": offset, "size": len(data), "data": data}))
-                except Exception as exp:
-                    self.log.warn("Failed to schedule chunk upload - {}".format(exp))
-                    continue
-                try:
-                    fn = partial(factory.makeAllocation, **{**{'duration': duration},
-                                                            **self._depots[d.endpoint].to_JSON()})
-                    alloc = await asyncio.get_event_loop().run_in_executor(None, fn, data, offset, d)
-                except AllocationError:
-                    self._jobs.put_nowait((offset, size))
-                    continue
-                
-                ## Create Allocation ##
-                alloc = alloc.getMetadata()
-                self._record.append(('U', alloc, offset, rsize))
-                self._viz_progress(sock, alloc.location, alloc.size, alloc.offset, progress_cb)
-                self.log.info("[{}] Uploaded: {}-{}".format(rank, offset, offset+rsize))
-                allocs.append(alloc)
-                uploaded += len(data)
+        allocs, fanouts = [], []
+        while not self._jobs.empty():
+            offset, size, fan = await self._jobs.get()
+            data = source.view(offset, size)
+            rsize = len(data)
+            
+            ## Upload chunk ##
+            try:
+                d = Depot(schedule.get({"offset": offset, "size": len(data), "data": data}))
+            except Exception as exp:
+                self.log.warn("Failed to schedule chunk upload - {}".format(exp))
+                continue
+            try:
+                kwargs = {**{'duration': duration}, **self._depots[d.endpoint].to_JSON()}
+                alloc = await factory.makeAllocationAsync(data, offset, d, **kwargs)
+            except AllocationError:
+                self._jobs.put_nowait((offset, size, fan))
+                continue
+            
+            ## Create Allocation ##
+            alloc = alloc.getMetadata()
+            _landed(alloc, rsize)
+            self.log.info("[{}] Uploaded: {}-{}".format(rank, offset, offset+rsize))
+            uploaded += len(data)
+            if fan:
+                fanouts.append(asyncio.ensure_future(
+                    self._fan_out(source, alloc, rsize, fan, schedule, duration, slots, _landed)))
 
+        await asyncio.gather(*fanouts)
         return (uploaded, allocs)
+
+    @trace.debug("Session")
+    async def _fan_out(self, source, alloc, rsize, copies, schedule, duration, slots, landed):
+        """
+        Add `copies` replicas of a freshly uploaded block by chaining depot
+        to depot copies, each new replica feeding the next, so the client
+        sends the block only once.  A replica whose copy fails is uploaded
+        from the source file instead.
+        """
+        src = alloc
+        for _ in range(copies):
+            try:
+                dest = Depot(schedule.get({"offset": alloc.offset, "size": rsize}))
+            except Exception as exp:
+                self.log.warn("Failed to schedule chunk replica - {}".format(exp))
+                return
+            try:
+                async with slots[Depot(src.location).endpoint]:
+                    replica = await self._copy_block(src, dest, duration)
+            except Exception as exp:
+                self.log.warn("Fan-out to {} failed, uploading replica - {}".format(dest.endpoint, exp))
+                try:
+                    kwargs = {**{'duration': duration}, **self._depots[dest.endpoint].to_JSON()}
+                    data = source.view(alloc.offset, rsize)
+                    replica = (await factory.makeAllocationAsync(data, alloc.offset, dest, **kwargs)).getMetadata()
+                except AllocationError as exp:
+                    self.log.warn("Failed to upload replica - {}".format(exp))
+                    continue
+            landed(replica, rsize)
+            self.log.info("Replicated: {}-{} to {}".format(alloc.offset, alloc.offset + rsize, dest.endpoint))
+            src = replica
         
+    @trace.debug("Session")
+    def _publish_extents(self, ex, allocs):
+        """
+        Attach allocs to ex and commit them to UNIS in batches of
+        md_batch documents, flushing each batch as one bulk update.
+        """
+        for i in range(0, len(allocs), self._md_batch):
+            for alloc in allocs[i:i + self._md_batch]:
+                alloc.parent = ex
+                alloc.getObject().__dict__['selfRef'] = ''
+                try: del alloc.getObject().__dict__['function']
+                except KeyError: pass
+                ex.extents.append(alloc)
+                self._runtime.insert(alloc, commit=True)
+            if self._do_flush:
+                self._runtime.flush()
+        if self._do_flush and not allocs:
+            self._runtime.flush()
+
+    @trace.debug("Session")
+    async def _publish_stream(self, ex, published):
+        """
+        Publish allocs from the published queue as they land.  Allocs that
+        arrive while a batch is being committed are coalesced into the next
+        one, and a None entry ends the stream.  Returns the time spent
+        committing metadata.
+        """
+        loop, elapsed, done = asyncio.get_event_loop(), 0, False
+        while not done:
+            batch = [await published.get()]
+            while not published.empty() and len(batch) < self._md_batch:
+                batch.append(published.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if batch:
+                t = time.time()
+                await loop.run_in_executor(None, self._publish_extents, ex, batch)
+                elapsed += time.time() - t
+        return elapsed
+
     @trace.info("Session")
-    def upload(self, path, filename=None, folder=None, copies=COPIES, duration=None, schedule=None, progress_cb=None):
+    def upload(self, path, filename=None, folder=None, copies=COPIES, duration=None, schedule=None, progress_cb=None,
+               resume=False, stream=False, fanout=False):
+        """
+        Upload the file at path.  With stream set the exnode is inserted
+        before any data moves and extents are published as their blocks
+        land, so readers may follow the file while it is being written;
+        compare the extents against ex.size to tell when it is complete.
+        Otherwise nothing is inserted until every block has landed.  With
+        fanout set each block is uploaded once and the remaining copies are
+        made depot to depot, see `_fan_out`.
+        """
         async def _awrapper(schedule, sock):
-            workers = [self._upload_chunks(path, schedule, duration, sock, r, progress_cb) for r in range(self._threads)]
-            result = await asyncio.gather(*workers)
+            nonlocal md_time
+            published = asyncio.Queue() if stream else None
+            slots = defaultdict(lambda: asyncio.Semaphore(self._threads))
+            workers = [self._upload_chunks(source, schedule, duration, sock, r, progress_cb, journal, published, slots)
+                       for r in range(self._threads)]
+            if not stream:
+                return await asyncio.gather(*workers)
+            publisher = asyncio.ensure_future(self._publish_stream(ex, published))
+            try:
+                result = await asyncio.gather(*workers)
+            finally:
+                published.put_nowait(None)
+                md_time += await publisher
             return result
         
         schedule = schedule or BaseUploadSchedule()
@@ -190,40 +342,86 @@ class Session(object):
         
         schedule.setSource(self._depots)
 
+        ## Restore staged allocations ##
+        journal, all_allocs = None, []
+        if resume:
+            journal = TransferJournal("upload", os.path.abspath(path), stat.st_size, stat.st_mtime,
+                                      self._blocksize, copies)
+            all_allocs = self._resume_upload(journal)
+
         time_s = time.time()
-        uploaded = 0
-        all_allocs = []
+        uploaded, md_time = 0, 0
+        if stream:
+            self._runtime.insert(ex, commit=True)
+            self._publish_extents(ex, all_allocs)
+            md_time = time.time() - time_s
+
         ## Generate tasks ##
-        self._generate_jobs(self._blocksize, ex.size, copies)
-        for upsize, allocs in make_async(_awrapper, schedule, sock):
-            uploaded += upsize
-            all_allocs.extend(allocs)
+        self._generate_jobs(self._blocksize, ex.size, copies, Counter(a.offset for a in all_allocs), fanout)
+        if stream: all_allocs = []
+        with UploadSource(path) as source:
+            for upsize, allocs in make_async(_awrapper, schedule, sock):
+                uploaded += upsize
+                all_allocs.extend(allocs)
         
         time_e = time.time()
-        self._runtime.insert(ex, commit=True)
-        for alloc in all_allocs:
-            alloc.parent = ex
-            alloc.getObject().__dict__['selfRef'] = ''
-            del alloc.getObject().__dict__['function']
-            ex.extents.append(alloc)
-            self._runtime.insert(alloc, commit=True)
+        if not stream:
+            self._runtime.insert(ex, commit=True)
+            self._publish_extents(ex, all_allocs)
+            md_time = time.time() - time_e
+        if journal:
+            journal.remove()
 
-        if self._do_flush:
-            self._runtime.flush()
-
-        return UploadResult(time_e - time_s, uploaded, ex)
+        return UploadResult(time_e - time_s, uploaded, ex, md_time)
     
     
+    async def _read_block(self, alloc, lo, hi, buffer=None):
+        service = factory.buildAllocation(alloc)
+        kwargs = {**self._depots[Depot(alloc.location).endpoint].to_JSON(),
+                  'offset': lo - alloc.offset, 'size': hi - lo}
+        return await service.aread(buffer=buffer, **kwargs)
+
     @trace.debug("Session")
-    async def _download_chunks(self, filepath, schedule, sock, rank, progress_cb):
-        def _write(fh, offset, data):
-            async def _noop():
-                return 0
-            fh.seek(offset)
-            if data:
-                return asyncio.get_event_loop().run_in_executor(None, fh.write, data)
-            return _noop()
-        fh = open(filepath, 'wb')
+    async def _hedged_read(self, alloc, lo, hi, view, replicas, hedge):
+        """
+        Read [lo, hi) from alloc into view.  If the read outlives the hedge
+        deadline a duplicate read is sent to a replica covering the same
+        range on another depot; the first to succeed is returned and the
+        other cancelled.  Returns the data and whether the duplicate
+        served it.
+        """
+        primary = asyncio.ensure_future(self._read_block(alloc, lo, hi, view))
+        deadline = hedge.deadline(hi - lo) if hedge else None
+        if deadline is None: return await primary, False
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        if done: return primary.result(), False
+
+        depot = Depot(alloc.location).endpoint
+        alt = next((r for r in replicas.covering(lo)
+                    if r.offset + r.size >= hi and Depot(r.location).endpoint != depot and \
+                    Depot(r.location).endpoint in self._depots), None)
+        if alt is None: return await primary, False
+        hedge.fired += 1
+        self.log.debug("Hedging block {}-{} on {}".format(lo, hi, alt.location))
+        secondary = asyncio.ensure_future(self._read_block(alt, lo, hi))
+        pending, exp = {primary, secondary}, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if fut.exception() is None:
+                        if fut is secondary: hedge.won += 1
+                        return fut.result(), fut is secondary
+                    exp = fut.exception()
+            raise exp
+        finally:
+            # The losing read must stop writing into the sink before returning
+            for fut in pending: fut.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    @trace.debug("Session")
+    async def _download_chunks(self, sink, start, schedule, sock, rank, progress_cb, replicas=None, hedge=None,
+                               journal=None):
         downloaded = 0
         while not self._jobs.empty():
             offset, end = self._jobs.get_nowait()
@@ -232,42 +430,52 @@ class Session(object):
             except IndexError as exp:
                 self.log.warn(exp)
                 continue
-            if alloc.offset + alloc.size < end:
-                await self._jobs.put((offset + alloc.size, end))
+            lo, hi = offset, min(end, alloc.offset + alloc.size)
+            if hi < end:
+                await self._jobs.put((hi, end))
             
             ## Download chunk ##
-            d = Depot(alloc.location)
-            service = factory.buildAllocation(alloc)
-            loop = asyncio.get_event_loop()
+            t = time.time()
             try:
-                fn = partial(service.read, **self._depots[d.endpoint].to_JSON())
-                data = await loop.run_in_executor(None, fn)
-            except AllocationError as exp:
+                data, hedged = await self._hedged_read(alloc, lo, hi, sink.view(lo - start, hi - lo), replicas, hedge)
+            except (AllocationError, OSError) as exp:
+                schedule.complete({"alloc": alloc, "offset": offset, "error": exp})
                 self.log.warn("Unable to download block - {}".format(exp))
-                await self._jobs.put((offset, offset + alloc.size))
+                await self._jobs.put((lo, hi))
                 continue
+            if hedged:
+                schedule.complete({"alloc": alloc, "offset": offset, "error": TimeoutError("Hedged read won")})
+            else:
+                schedule.complete({"alloc": alloc, "offset": offset, "size": len(data), "time": time.time() - t})
+                if hedge: hedge.record(len(data), time.time() - t)
             if data:
                 self._record.append(('D', alloc, offset, len(data)))
-                self.log.info("[{}] Downloaded: {}-{}".format(rank, offset, offset+len(data)))
-                self._viz_progress(sock, alloc.location, alloc.size, alloc.offset, progress_cb)
-                length = await _write(fh, alloc.offset, data)
-                downloaded += length
+                self.log.info("[{}] Downloaded: {}-{}".format(rank, lo, lo+len(data)))
+                self._viz_progress(sock, alloc.location, len(data), lo, progress_cb)
+                downloaded += sink.write(lo - start, data)
+                if journal: journal.record(lo=lo, hi=lo + len(data))
             else:
-                await self._jobs.put((offset, offset + alloc.size))
+                await self._jobs.put((lo, hi))
         
-        fh.close()
         return downloaded
         
     @trace.info("Session")
-    def download(self, href, folder=None, length=0, offset=0, schedule=None, progress_cb=None, filename=None):
-        async def _awrapper(folder, schedule, sock):
-            workers = [self._download_chunks(folder, schedule, sock, r, progress_cb) for r in range(self._threads)]
+    def download(self, href, folder=None, length=0, offset=0, schedule=None, progress_cb=None, filename=None, hedge=None,
+                 resume=False, striped=False):
+        async def _awrapper(sink, schedule, sock):
+            workers = [self._download_chunks(sink, start, schedule, sock, r, progress_cb, replicas, hedge, journal)
+                       for r in range(self._threads)]
             return await asyncio.gather(*workers)
 
         schedule = schedule or BaseDownloadSchedule()
         ex = next(self._runtime.exnodes.where({'selfRef': href}))
-        allocs = ex.extents
+        start = min(offset, ex.size)
+        stop = min(start + length, ex.size) if length else ex.size
+        allocs = [a for a in ex.extents if a.offset < stop and a.offset + a.size > start]
         schedule.setSource(allocs)
+        replicas = ExtentIndex(allocs)
+        if hedge:
+            hedge = _Hedge(HEDGE_PERCENTILE if hedge is True else hedge)
         locs = {}
         
         # bin extents and locations
@@ -280,87 +488,164 @@ class Session(object):
             folder = filename or ex.name
             
         # register download with Periscope
-        sock = self._viz_register(ex.name, ex.size, len(locs))
+        sock = self._viz_register(ex.name, stop - start, len(locs))
         
+        gaps, journal = [(start, stop)], None
+        if resume:
+            journal = TransferJournal("download", href, os.path.abspath(folder), start, stop)
+            gaps = self._resume_download(journal, start, stop)
+
+        jobs = gaps
+        if striped:
+            # Spread every gap over the replicas block by block, weighted
+            # by the given capacities or those the schedule has observed
+            weights = striped if isinstance(striped, dict) else None
+            if weights is None and hasattr(schedule, "stats"):
+                weights = {k: v["bw"] for k, v in schedule.stats().items() if v["bw"]}
+            info, plan = ExnodeInfo(ex), defaultdict(list)
+            for lo, hi in gaps:
+                for endpoint, work in info.plan_striped(lo, hi, weights, self._blocksize).items():
+                    plan[endpoint].extend(work)
+            schedule = StripedDownloadSchedule(plan, schedule)
+            jobs = sorted((lo, hi) for work in plan.values() for _, lo, hi in work)
+
         time_s = time.time()
-        self._jobs.put_nowait((0, ex.size))
-        if self._threads > 1:
-            downloaded = sum(make_async(_awrapper, folder, schedule, sock))
-        else:
-            offset = 0
-            with open(folder, 'wb') as fh:
-                while offset < ex.size:
-                    try:
-                        alloc = schedule.get({"offset": offset})
-                    except IndexError as exp:
-                        self.log.warn(exp)
-                        break
-                    d = Depot(alloc.location)
-                    service = factory.buildAllocation(alloc)
-                    try:
-                        data = service.read(**self._depots[d.endpoint].to_JSON())
-                    except AllocationError as exp:
-                        self.log.warn("Unable to download block - {}".format(exp))
-                        continue
-                    if data:
-                        self.log.info("Downloaded: {}-{}".format(offset, offset+len(data)))
-                        self._viz_progress(sock, alloc.location, alloc.size, alloc.offset, progress_cb)
-                        fh.seek(alloc.offset)
-                        length = fh.write(data)
-                        offset += length
-            downloaded = offset
-        
+        self._jobs = asyncio.Queue()
+        for job in jobs:
+            self._jobs.put_nowait(job)
+        with DownloadSink(folder, stop - start, truncate=gaps == [(start, stop)]) as sink:
+            if self._threads > 1 or hedge:
+                downloaded = sum(make_async(_awrapper, sink, schedule, sock))
+            else:
+                downloaded = 0
+                for offset, end in gaps:
+                    while offset < end:
+                        try:
+                            alloc = schedule.get({"offset": offset})
+                        except IndexError as exp:
+                            self.log.warn(exp)
+                            break
+                        d = Depot(alloc.location)
+                        service = factory.buildAllocation(alloc)
+                        hi = min(end, alloc.offset + alloc.size)
+                        t = time.time()
+                        try:
+                            data = service.read(buffer=sink.view(offset - start, hi - offset),
+                                                **{**self._depots[d.endpoint].to_JSON(),
+                                                   'offset': offset - alloc.offset, 'size': hi - offset})
+                        except AllocationError as exp:
+                            schedule.complete({"alloc": alloc, "offset": offset, "error": exp})
+                            self.log.warn("Unable to download block - {}".format(exp))
+                            continue
+                        schedule.complete({"alloc": alloc, "offset": offset, "size": len(data), "time": time.time() - t})
+                        if data:
+                            self.log.info("Downloaded: {}-{}".format(offset, offset+len(data)))
+                            self._viz_progress(sock, alloc.location, len(data), offset, progress_cb)
+                            length = sink.write(offset - start, data)
+                            if journal: journal.record(lo=offset, hi=offset + length)
+                            offset += length
+                            downloaded += length
+                        del data
+
+        if journal:
+            if downloaded >= sum(hi - lo for lo, hi in gaps): journal.remove()
+            else: journal.close()
+        if hedge:
+            self.log.info("Hedged reads: {} fired, {} won".format(hedge.fired, hedge.won))
+            return DownloadResult(time.time() - time_s, downloaded, ex, hedge.fired, hedge.won)
         return DownloadResult(time.time() - time_s, downloaded, ex)
         
-    @trace.info("Session")
-    def copy(self, href, duration=None, download_schedule=BaseDownloadSchedule(), upload_schedule=BaseUploadSchedule(), progress_cb=None):
-        def offsets(size):
-            i = 0
-            while i < size:
-                ext = download_schedule.get({"offset": i})
-                yield ext
-                i += ext.size
-        def _copy_chunk(name, size, sock_down, sock_up):
-            def _f(ext):
+    @trace.debug("Session")
+    async def _copy_block(self, ext, dest, duration):
+        src = Depot(ext.location)
+        src_kwargs = self._depots[src.endpoint].to_JSON() if src.endpoint in self._depots else {}
+        dst_kwargs = {**{'duration': duration}, **self._depots[dest.endpoint].to_JSON()}
+        alloc = factory.buildAllocation(ext)
+        if src.scheme == dest.scheme:
+            return (await alloc.acopy(dest, src_kwargs, dst_kwargs)).getMetadata()
+        # Different protocols, the block has to pass through the client
+        data = await alloc.aread(**src_kwargs)
+        return (await factory.makeAllocationAsync(data, ext.offset, dest, **dst_kwargs)).getMetadata()
+
+    @trace.debug("Session")
+    async def _copy_chunks(self, jobs, schedule, duration, slots, socks, progress_cb):
+        copied, allocs = 0, []
+        src_slots, dst_slots = slots
+        while not jobs.empty():
+            ext = jobs.get_nowait()
+            src = Depot(ext.location)
+            async with src_slots[src.endpoint]:
+                ## Pick a destination other than the source ##
+                dest = None
                 try:
-                    alloc = factory.buildAllocation(ext)
-                    src_desc = Depot(ext.location)
-                    dest_desc = Depot(upload_schedule.get({"offset": ext.offset, "size": ext.size}))
-                    src_depot = self._depots[src_desc.endpoint]
-                    dest_depot = self._depots[dest_desc.endpoint]
-                    dst_alloc = alloc.copy(dest_desc, src_depot.to_JSON(), dest_depot.to_JSON(), **kwargs)
-                    dst_ext = dst_alloc.getMetadata()
-                    self._viz_progress(sock_down, name, size, ext.location, ext.size, ext.offset, progress_cb)
-                    self._viz_progress(sock_up, name, size, dst_ext.location, dst_ext.size, dst_ext.offset, progress_cb)
-                    return (ext, dst_ext)
+                    for _ in range(len(self._depots)):
+                        dest = Depot(schedule.get({"offset": ext.offset, "size": ext.size}))
+                        if dest.endpoint != src.endpoint: break
+                        dest = None
                 except Exception as exp:
-                    self.log.warn ("READ Error: {}".format(exp))
-                return ext, False
-            return _f
-        
+                    self.log.warn("Failed to schedule chunk copy - {}".format(exp))
+                if dest is None:
+                    self.log.warn("No destination for {}-{}".format(ext.offset, ext.offset + ext.size))
+                    continue
+
+                async with dst_slots[dest.endpoint]:
+                    try:
+                        alloc = await self._copy_block(ext, dest, duration)
+                    except Exception as exp:
+                        self.log.warn("Failed to copy {}-{} to {} - {}".format(ext.offset, ext.offset + ext.size,
+                                                                               dest.endpoint, exp))
+                        continue
+            self._viz_progress(socks[0], ext.location, ext.size, ext.offset, None)
+            self._viz_progress(socks[1], alloc.location, alloc.size, alloc.offset, progress_cb)
+            self.log.info("Copied: {}-{} to {}".format(alloc.offset, alloc.offset + alloc.size, dest.endpoint))
+            allocs.append(alloc)
+            copied += alloc.size
+        return (copied, allocs)
+
+    @trace.info("Session")
+    def copy(self, href, duration=None, download_schedule=None, upload_schedule=None, progress_cb=None):
+        """
+        Replicate the exnode at href onto the session's depots.  Blocks move
+        depot to depot where both ends speak the same protocol, IBP_SEND
+        for IBP, and only pass through the client otherwise.  At most
+        `threads` copies are in flight from any one source depot and into
+        any one destination depot.
+        """
+        async def _awrapper(jobs):
+            slots = (defaultdict(lambda: asyncio.Semaphore(self._threads)),
+                     defaultdict(lambda: asyncio.Semaphore(self._threads)))
+            workers = [self._copy_chunks(jobs, upload_schedule, duration, slots, (sock_down, sock_up), progress_cb)
+                       for _ in range(self._threads * max(len(self._depots), 1))]
+            return await asyncio.gather(*workers)
+
+        download_schedule = download_schedule or BaseDownloadSchedule()
+        upload_schedule = upload_schedule or BaseUploadSchedule()
         ex = next(self._runtime.exnodes.where({'selfRef': href}))
-        allocs = ex.extents
-        futures = []
-        download_schedule.setSource(allocs)
+        download_schedule.setSource(ex.extents)
         upload_schedule.setSource(self._depots)
+
+        ## Pick one source replica for each range ##
+        jobs, offset = asyncio.Queue(), 0
+        while offset < ex.size:
+            try:
+                ext = download_schedule.get({"offset": offset})
+            except IndexError as exp:
+                self.log.warn("Unable to copy remainder of file - {}".format(exp))
+                break
+            jobs.put_nowait(ext)
+            offset = ext.offset + ext.size
         
         sock_up = self._viz_register("{}_upload".format(ex.name), ex.size, len(self._depots))
         sock_down = self._viz_register("{}_download".format(ex.name), ex.size, len(self._depots))
-        copied = 0
+        copied, all_allocs = 0, []
         time_s = time.time()
-        with ThreadPoolExecutor(max_workers=self._threads) as executor:
-            for src_alloc, dst_alloc  in executor.map(_copy_chunk(sock_down, sock_up), offsets(ex.size)):
-                alloc = dst_alloc
-                self._runtime.insert(alloc, commit=True)
-                alloc.parent = ex
-                ex.extents.append(alloc)
-                copied += alloc.size
-        
+        for size, allocs in make_async(_awrapper, jobs):
+            copied += size
+            all_allocs.extend(allocs)
         time_e = time.time()
-        
-        if self._do_flush:
-            self._runtime.flush()
-        return (time_e - time_s, ex)
+
+        self._publish_extents(ex, all_allocs)
+        return CopyResult(time_e - time_s, copied, ex)
         
     @trace.info("Session")
     def mkdir(self, path):
@@ -428,5 +713,9 @@ class Session(object):
         return self
 
     def __exit__(self, ex_ty, ex_val, tb):
+        try:
+            factory.shutdown()
+        except Exception as exp:
+            self.log.warn("Failed to release protocol resources - {}".format(exp))
         if not self._external_rt:
             self._runtime.shutdown()
@@ -11,3 +11,8 @@ BLOCKSIZE = 262144
 COPIES = 1
 THREADS = 5
 TIMEOUT = 180
+HEDGE_PERCENTILE = 95
+HEDGE_SAMPLES = 10
+MD_BATCH = 1000
+READAHEAD = 4
+CACHE_SIZE = 67108864
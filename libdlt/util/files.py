@@ -1,34 +1,118 @@
-import logging, threading, queue, socket
+import bisect, logging, mmap, os, queue, socket, time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from libdlt.depot import Depot
 from libdlt.protocol import factory
+from libdlt.settings import THREADS
 
 log = logging.getLogger('libdlt.utils')
+class ExtentIndex(object):
+    """
+    Extents bucketed by starting offset.  Lookups bisect the sorted
+    offsets and only walk back as far as the largest extent, so finding
+    every replica covering a position costs O(log n) plus the number of
+    replicas.  `key` maps stored items to their extent when the index
+    holds wrapper objects rather than extents.
+    """
+    def __init__(self, extents=(), key=None):
+        self._key = key or (lambda x: x)
+        self._offsets, self._buckets, self._span = [], {}, 0
+        for e in sorted(extents, key=lambda x: self._key(x).offset): self.add(e)
+
+    def add(self, item):
+        ext = self._key(item)
+        if ext.offset not in self._buckets:
+            bisect.insort(self._offsets, ext.offset)
+            self._buckets[ext.offset] = []
+        self._buckets[ext.offset].append(item)
+        self._span = max(self._span, ext.size)
+
+    def buckets(self, start, end=None):
+        """
+        Yield (offset, items) for each bucket that may hold an extent
+        overlapping [start, end) in offset order.  The item lists are the
+        index's own and may be reordered in place by the caller.
+        """
+        end = start + 1 if end is None else end
+        lo = bisect.bisect_right(self._offsets, start - self._span)
+        hi = bisect.bisect_left(self._offsets, end)
+        for i in range(lo, hi):
+            yield self._offsets[i], self._buckets[self._offsets[i]]
+
+    def overlapping(self, start, end=None):
+        for _, items in self.buckets(start, end):
+            for item in items:
+                ext = self._key(item)
+                if ext.offset + ext.size > start: yield item
+
+    def covering(self, offset):
+        return list(self.overlapping(offset))
+
+    def __len__(self):
+        return sum(len(v) for v in self._buckets.values())
+
+class IntervalSet(object):
+    """
+    Disjoint half-open intervals kept sorted in parallel arrays of starts
+    and ends.  `add` bisects for the neighbours of the new interval and
+    merges any it overlaps or touches, so adding intervals in offset
+    order is close to linear overall and membership is O(log n).
+    """
+    def __init__(self):
+        self._starts, self._ends = [], []
+
+    def add(self, start, end):
+        if end <= start: return
+        lo = bisect.bisect_left(self._ends, start)
+        hi = bisect.bisect_right(self._starts, end)
+        if lo < hi:
+            start, end = min(start, self._starts[lo]), max(end, self._ends[hi - 1])
+        self._starts[lo:hi], self._ends[lo:hi] = [start], [end]
+
+    def covers(self, start, end):
+        i = bisect.bisect_right(self._starts, start) - 1
+        return end <= start or (i >= 0 and self._ends[i] >= end)
+
+    def gaps(self, start, end):
+        result, offset = [], start
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        for s, e in zip(self._starts[i:], self._ends[i:]):
+            if offset >= end: break
+            if s > offset: result.append([offset, min(s, end)])
+            offset = max(offset, e)
+        if offset < end: result.append([offset, end])
+        return result
+
+    def __contains__(self, offset):
+        i = bisect.bisect_right(self._starts, offset) - 1
+        return i >= 0 and offset < self._ends[i]
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        return len(self._starts)
+
 class ExnodeInfo(object):
-    def __init__(self, ex, remote_validate=False, accept_timeout=True, threadcount=1):
-        class _view(object):
-            def __init__(self): self._size, self._chunks = ex.size, [[0,0]]
-            def fill(self, o, s):
-                self._chunks = list(sorted(self._chunks + [[o,o+s]]))
-                new_chunks = [[0,0]]
-                for chunk in self._chunks:
-                    if chunk[0] <= new_chunks[-1][1]: new_chunks[-1][1] = chunk[1]
-                    else: new_chunks.append(chunk)
-                self._chunks = new_chunks
+    def __init__(self, ex, remote_validate=False, accept_timeout=True, threadcount=THREADS, deadline=None):
+        class _view(IntervalSet):
+            def __init__(self):
+                super().__init__()
+                self._size = ex.size
+            def fill(self, o, s): self.add(o, o + s)
             @property
             def is_complete(self):
-                return self._chunks[0][-1] == self._size
+                return self.covers(0, self._size)
             @property
             def missing(self):
-                result = [[self._chunks[i][1], self._chunks[i+1][0]] for i in range(len(self._chunks) - 1)]
-                return result if self._chunks[-1][1] == ex.size else result + [[self._chunks[-1][1], ex.size]]
+                return self.gaps(0, self._size)
 
             def valid(self, offset):
-                return any([c[0] <= offset < c[1] for c in self._chunks])
+                return offset in self
 
         self._allocs, self._views = [], defaultdict(_view)
-        self._tc = threadcount
+        self._tc, self._deadline = threadcount, deadline
         self._timeout_ok = accept_timeout
         allocs = sorted(ex.extents, key=lambda x: x.offset)
         self._meta = self._validate(allocs) if remote_validate else defaultdict(lambda: True)
@@ -44,30 +128,55 @@ class ExnodeInfo(object):
         return self._views.items()
 
     def _validate(self, allocs):
-        results = {}
+        """
+        Probe allocs on a pool of `threadcount` workers.  Each depot's
+        status is queried once ahead of its allocations, which are marked
+        invalid without a probe if the depot is down.  Anything still
+        outstanding after `deadline` seconds is treated as a timeout.
+        """
+        def status(x):
+            _proxy = factory.makeProxy(x)
+            if not hasattr(_proxy, 'getStatus'): return True
+            try:
+                _proxy.getStatus(x.depot, timeout=0.5)
+                return True
+            except socket.timeout as e:
+                return self._timeout_ok
+            except OSError as e:
+                log.warn("Failed to connect with depot - " + x.location)
+                return False
+            except Exception as e:
+                # The depot answered, if only with an error, so its
+                # allocations are still probed one by one
+                log.debug("Depot status refused - {} - {}".format(x.location, e))
+                return True
+
         def run(x):
+            if not depots[x.location].result(): return False
             _proxy = factory.makeProxy(x)
-            if not hasattr(x, 'depot'): x.depot = Depot(x.location)
             try:
-                v = _proxy.probe(x, timeout=0.5)
-                results[x.id] = v
+                return _proxy.probe(x, timeout=0.5)
             except socket.timeout as e:
-                results[x.id] = self._timeout_ok
+                return self._timeout_ok
             except Exception as e:
                 log.warn("Failed to connect with allocation - " + x.location)
-                results[x.id] = False
+                return False
 
-        threads = []
-        for e in allocs:
-            if len(threads) >= self._tc:
-                [t.join() for t in threads]
-                threads = []
-            t = threading.Thread(target=run, args=(e,))
-            threads.append(t)
-            t.daemon = True
-            t.start()
-        [t.join() for t in threads]
-        return results
+        end = time.time() + self._deadline if self._deadline is not None else None
+        pool = ThreadPoolExecutor(max_workers=max(self._tc, 1))
+        try:
+            # Status checks are queued first, so probes waiting on them
+            # never hold every worker
+            depots = {}
+            for x in allocs:
+                if x.location not in depots: depots[x.location] = pool.submit(status, x)
+            probes = {pool.submit(run, x): x for x in allocs}
+            done, pending = wait(probes, timeout=None if end is None else max(end - time.time(), 0))
+            if pending:
+                log.warn("Validation deadline reached with {} probes outstanding".format(len(pending)))
+            return {x.id: f.result() if f in done else self._timeout_ok for f, x in probes.items()}
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
     def is_complete(self, view=None):
         if view: return view in self._views and self._views[view].is_complete
@@ -108,6 +217,40 @@ class ExnodeInfo(object):
                 start  = alloc.offset + alloc.size
             if start >= end: break
 
+    def plan_striped(self, start=0, end=None, weights=None, chunk=None):
+        """
+        Split [start, end) between every replica that covers it.  The range
+        is cut at each extent boundary, so replicas with misaligned extents
+        still share the work, and every `chunk` bytes when given, so a range
+        inside a single extent is spread as well and no piece is larger than
+        `chunk`.  Each piece goes to the covering depot with the least work
+        relative to its weight.  `weights` maps depot endpoints to relative
+        capacity, such as observed throughput, and depots not listed weigh 1.
+        Returns {endpoint: [(alloc, lo, hi)]} in offset order; ranges no
+        valid extent covers are left out.
+        """
+        size = max([v._size for v in self._views.values()], default=0)
+        end = min(end or size, size)
+        weights, load, plan = weights or {}, defaultdict(int), defaultdict(list)
+        allocs = [a for a in self._allocs if a.offset < end and a.offset + a.size > start]
+        endpoints = {id(a): Depot(a.location).endpoint for a in allocs}
+        cuts = {start, end} | {min(max(p, start), end) for a in allocs for p in (a.offset, a.offset + a.size)}
+        cuts = sorted(cuts | set(range(start, end, chunk)) if chunk else cuts)
+        active, i = [], 0
+        for lo, hi in zip(cuts, cuts[1:]):
+            while i < len(allocs) and allocs[i].offset <= lo:
+                active.append(allocs[i])
+                i += 1
+            active = [a for a in active if a.offset + a.size > lo]
+            if not active: continue
+            alloc = min(active, key=lambda a: (load[endpoints[id(a)]] + hi - lo) / (weights.get(endpoints[id(a)], 1) or 1e-9))
+            endpoint = endpoints[id(alloc)]
+            load[endpoint] += hi - lo
+            work = plan[endpoint]
+            if work and work[-1][0] is alloc and work[-1][2] == lo and not chunk: work[-1] = (alloc, work[-1][1], hi)
+            else: work.append((alloc, lo, hi))
+        return dict(plan)
+
     def alloc_in(self, offset):
         for alloc in self._allocs:
             if alloc.offset <= offset and alloc.offset + alloc.size > offset:
@@ -115,3 +258,78 @@ class ExnodeInfo(object):
 
     def __getitem__(self, e):
         return self._meta[e]
+
+
+class UploadSource(object):
+    """
+    Source file for an upload, mapped once and shared by every worker.
+    `view` returns a zero-copy slice of the file that can be handed
+    directly to a protocol store.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self._size = os.fstat(fh.fileno()).st_size
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if self._size else None
+        if self._mm is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    def view(self, offset, size):
+        if self._mm is None: return memoryview(b'')
+        return memoryview(self._mm)[offset:offset+size]
+
+    def close(self):
+        if self._mm is not None:
+            try: self._mm.close()
+            except BufferError: log.debug("Source still referenced, deferring unmap")
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DownloadSink(object):
+    """
+    Destination file for a download.  The file is sized once up front and
+    mapped so workers can load blocks straight into place through `view`,
+    or hand finished blocks to `write`, without sharing a file position.
+    """
+    def __init__(self, path, size, truncate=True):
+        self._size = size
+        flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        self._fd = os.open(path, flags, 0o644)
+        os.ftruncate(self._fd, size)
+        if size and hasattr(os, 'posix_fallocate'):
+            try: os.posix_fallocate(self._fd, 0, size)
+            except OSError: pass
+        self._mm = mmap.mmap(self._fd, size) if size else None
+
+    def view(self, offset, size):
+        if self._mm is None or offset < 0 or offset + size > self._size: return None
+        return memoryview(self._mm)[offset:offset+size]
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        if view.obj is self._mm: return view.nbytes
+        n = 0
+        while n < view.nbytes:
+            n += os.pwrite(self._fd, view[n:], offset + n)
+        return n
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.flush()
+            try: self._mm.close()
+            except BufferError: log.debug("Sink still referenced, deferring unmap")
+            self._mm = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
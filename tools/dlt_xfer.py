@@ -44,6 +44,8 @@ def main():
                         help='Recurse into subdirectories')
     parser.add_argument('-c', '--cert', type=str, default=None,
                         help='SSL Cert/Key for HTTPS endpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume interrupted transfers from the local journal')
 
     args = parser.parse_args()
     bs = args.bs
@@ -88,7 +90,7 @@ def main():
 
     for f in flist:
         try:
-            result = xfer(f, folder=args.output, progress_cb=progress)
+            result = xfer(f, folder=args.output, progress_cb=progress, resume=args.resume)
             diff, res = result.time, result.exnode
         except CollectionIndexError as e:
             print ("ERROR: invalid file or URL: {}".format(e))